@@ -7,8 +7,10 @@ the workers so this is were all the events trigger.
 """
 
 import flask
-from flask import Flask, request
+from flask import Flask, Response, request, stream_with_context
 import os
+import threading
+import time
 
 # from apscheduler.schedulers.background import BackgroundScheduler
 
@@ -16,23 +18,82 @@ import logging
 logging.basicConfig()
 
 import ccLib
+import metrics
+import workerBundle
 
 OK = 'okay'
 
+# Upper bound on the number of jobs handed out by one batch claim.
+MAX_CLAIM = 500
+
 app = Flask(__name__, static_url_path='')
 app.debug = True
 app.config.from_object('config')
 app.ccConfig = {}
 app.ccState = {}
-app.state = {'ip': ccLib.getMyIPAddress()}
-
-app.aws = ccLib.AWS()
-app.aws.createKeypairs()
-app.aws.pushSecurityGroups('worker')
+app.state = {}
 
-app.queue = ccLib.Job
+# Nothing slow happens before serving: provider setup runs in the
+# background and the public IP is looked up on first use.
+app.aws = ccLib.getProvider()
+app.aws.setup()
 
+# app.session is a scoped_session: each request thread gets its own
+# session (and connection from the engine's pool), discarded in
+# removeSession.
 app.session = ccLib.initDB()
+app.engine = ccLib.getDB()
+
+app.queue = ccLib.getQueue(app.engine)
+app.notifier = app.queue.getNotifier(app.engine)
+app.longPolls = threading.Semaphore(app.config['LONG_POLL_SLOTS'])
+
+if app.config['METRICS_DIR']:
+    metrics.share(app.config['METRICS_DIR'])
+
+@app.before_request
+def startTimer():
+    flask.g.start = time.time()
+    metrics.REQUESTS_IN_FLIGHT.inc()
+
+@app.after_request
+def noteStatus(response):
+    flask.g.status = response.status_code
+    return response
+
+@app.teardown_request
+def recordRequest(exc):
+    """
+    Count the request and time it, labelled by route pattern (not the
+    raw path, which would make a series per worker ip).  Done at
+    teardown, which also runs for requests that raised (after_request
+    doesn't), counting those as 500s.
+    """
+    if 'start' not in flask.g:
+        return
+    metrics.REQUESTS_IN_FLIGHT.dec()
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    status = 500 if exc is not None else flask.g.get('status', 500)
+    metrics.REQUESTS.inc(route=route, method=request.method, status=status)
+    metrics.REQUEST_LATENCY.observe(time.time() - flask.g.start, route=route)
+
+@app.teardown_appcontext
+def removeSession(exc):
+    """
+    Roll back anything left uncommitted and hand the request's
+    connection back to the pool.
+    """
+    app.session.remove()
+
+@app.route('/metrics')
+def getMetrics():
+    """
+    Prometheus scrape endpoint.
+    """
+    stats = app.queue.getStats(app.session)
+    for state, count in stats.items():
+        metrics.JOBS.set(count, state=state)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def index():
@@ -83,7 +144,27 @@ def hello(ip):
     Receive the Hello message from the worker.
     """
     ccLib.Worker.gotHello(app.session, ip)
-    return flask.json.jsonify({'result': app.state['ip']})
+    return flask.json.jsonify({'result': ccLib.getMyIPAddress()})
+
+@app.route('/api/bundle')
+def getBundle():
+    """
+    Describe the current worker bundle (see workerBundle.current), or
+    null if none is built yet.
+    """
+    return flask.json.jsonify({'result': workerBundle.current()})
+
+@app.route('/api/bundle/<sha256>.tar.gz')
+def getBundleFile(sha256):
+    """
+    Download a worker bundle by hash.  A hash always names the same
+    bytes, so it can be cached forever.
+    """
+    path = workerBundle.path(sha256)
+    if not path:
+        flask.abort(404)
+    return flask.send_file(path, mimetype='application/gzip',
+                           conditional=True, cache_timeout=365 * 24 * 3600)
 
 
 
@@ -98,6 +179,30 @@ def getWorkQueue():
     jobs = app.queue.getJobs(app.session, 20)
     return flask.json.jsonify({'result': jobs})
 
+@app.route('/api/work/stats')
+def getWorkStats():
+    """
+    Get the queue counters (queued, running, done, failed).  Cheap
+    regardless of queue size.
+    """
+    return flask.json.jsonify({'result': app.queue.getStats(app.session)})
+
+@app.route('/api/work/dead', methods=['GET'])
+def getDeadWork():
+    """
+    Get the 100 most recent jobs that were given up on, with their
+    last failure reason.
+    """
+    return flask.json.jsonify({'result': app.queue.getDead(app.session, 100)})
+
+@app.route('/api/work/dead', methods=['POST'])
+def requeueDeadWork():
+    """
+    Put every job that was given up on back in the queue.  Responds
+    with the number requeued.
+    """
+    return flask.json.jsonify({'result': app.queue.requeueDead(app.session)})
+
 @app.route('/api/work', methods=['DELETE'])
 def clearWork():
     """
@@ -113,18 +218,109 @@ def addWork():
 
     Post data should have a `urls` key associated with a
     list of strings.
+
+    Responds with the number of URLs inserted and the number
+    dropped as duplicates.
     """
     work = request.get_json()
-    app.queue.add(app.session, work['urls'])
-    return flask.json.jsonify({'result': OK})
+    counts = app.queue.add(app.session, work['urls'])
+    return flask.json.jsonify({'result': counts})
+
+def bodyStream():
+    """
+    Aborts with a 411 unless the server can tell whether the body
+    arrived whole: it needs a Content-Length, or, if sent chunked, a
+    server that de-chunks the body and sets wsgi.input_terminated
+    (gunicorn 19.10+, not werkzeug's development server).
+
+    @returns: file like -- the raw body of the request, to be read
+        without loading it all.  Reading raises IOError (gunicorn) or
+        aborts with a 400 (werkzeug's ClientDisconnected) if the body
+        ends early.
+    """
+    if request.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        # No Content-Length, so werkzeug's request.stream would be
+        # empty.
+        if not request.environ.get('wsgi.input_terminated'):
+            flask.abort(411)
+        return request.environ['wsgi.input']
+    if request.content_length is None:
+        flask.abort(411)
+    return request.stream
+
+@app.route('/api/work/upload', methods=['POST'])
+def uploadWork():
+    """
+    Submit a large number of URLs, one per line, as a streamed upload.
+
+    The body is either a multipart form with a `file` field or the
+    raw list itself, whatever its content type (e.g. `curl -T
+    urls.txt <cc>/api/work/upload`, which sends it chunked, or
+    `curl --data-binary @urls.txt`).  It is read a line at a time and never
+    held in memory as a whole.  An upload that is cut short is
+    answered with a 400; the URLs of its earlier chunks stay queued,
+    and sending it again only adds the rest.
+
+    Responds with the number of URLs inserted and the number
+    dropped as duplicates.
+    """
+    # Only a multipart body is parsed as a form.  Anything else is
+    # read raw, including curl --data-binary's default form encoding,
+    # which request.files would have werkzeug parse and buffer.
+    if request.mimetype == 'multipart/form-data':
+        if 'file' not in request.files:
+            flask.abort(400)
+        stream = request.files['file'].stream
+    else:
+        stream = bodyStream()
+    lines = iter(stream.readline, '')
+    try:
+        counts = app.queue.add(app.session, lines)
+    except IOError:
+        app.session.rollback()
+        flask.abort(400)
+    return flask.json.jsonify({'result': counts})
 
 @app.route('/api/work/<ip>')
 def getWork(ip):
     """
     Request a segment of work.  Respond with a URL to
     process.
+
+    If the `n` query parameter is given (e.g. /api/work/<ip>?n=50)
+    up to n URLs are claimed at once and the result is a list
+    (possibly empty) instead of a single URL or null.
+
+    If the `wait` query parameter is given and there is no work, the
+    request is held for up to `wait` seconds (at most
+    LONG_POLL_MAX) and answered as soon as jobs become claimable.
+    When LONG_POLL_SLOTS requests are already waiting it is answered
+    at once instead.
     """
-    work = app.queue.claim(app.session, ip)
+    count = request.args.get('n', type=int)
+    wait = min(request.args.get('wait', 0, type=float),
+               app.config['LONG_POLL_MAX'])
+    if count is not None:
+        count = max(1, min(count, MAX_CLAIM))
+    holding = wait > 0 and app.longPolls.acquire(False)
+    if not holding:
+        wait = 0
+    deadline = time.time() + wait
+    try:
+        while True:
+            if count is None:
+                work = app.queue.claim(app.session, ip)
+            else:
+                work = app.queue.claimBatch(app.session, ip, count)
+            remaining = deadline - time.time()
+            if work or remaining <= 0:
+                break
+            # Also look again every LONG_POLL_RECHECK seconds; backoffs
+            # and host limits expire without a notification.
+            app.notifier.wait(min(remaining, app.config['LONG_POLL_RECHECK']))
+    finally:
+        if holding:
+            app.longPolls.release()
     return flask.json.jsonify({'result': work})
 
 @app.route('/api/work/finish', methods=['POST'])
@@ -162,6 +358,132 @@ def failWork():
                 result.get('id'), result.get('data'))
     return flask.json.jsonify({'result': OK})
 
+@app.route('/api/work/heartbeat', methods=['POST'])
+def heartbeat():
+    """
+    Extend the leases on jobs a worker still holds.
+
+    Post data:
+        {
+        'id': IP address of worker,
+        'urls': list of the urls claimed and not yet turned in
+        }
+
+    Responds with the number of leases extended.
+    """
+    result = request.get_json()
+    extended = app.queue.heartbeat(app.session, result.get('id'),
+                result.get('urls') or [])
+    return flask.json.jsonify({'result': extended})
+
+@app.route('/api/work/results', methods=['POST'])
+def submitResults():
+    """
+    Turn in a batch of finished and failed work in one request.
+
+    Post data:
+        {
+        'id': IP address of worker,
+        'results': [
+            {
+            'op': 'finish' or 'fail',
+            'url': The url that was assigned,
+            'data': the results or information about the failure
+            },
+            ...
+            ]
+        }
+
+    Responds with the number of results applied.
+    """
+    result = request.get_json()
+    applied = app.queue.applyResults(app.session, result.get('id'),
+                result.get('results') or [])
+    return flask.json.jsonify({'result': applied})
+
+@app.route('/api/work/result', methods=['POST'])
+def streamResult():
+    """
+    Turn in the result of one job as the raw body of the request
+    (UTF-8, usually sent chunked), for pages too big to go through
+    /api/work/results.  The body is hashed and compressed as it is
+    read rather than parsed or held whole, and refused with a 413 if
+    it is over RESULT_MAX_BYTES.  A body that is cut short is refused
+    with a 400 (the job stays leased to the worker), and one whose
+    completeness can't be checked with a 411 (see bodyStream).
+
+    Query parameters:
+        id: IP address of worker
+        url: The url that was assigned
+
+    Responds with the number of results applied (0 if the job is no
+    longer the worker's, in which case the body isn't stored).
+    """
+    worker = request.args.get('id')
+    url = request.args.get('url')
+    if not worker or not url:
+        flask.abort(400)
+    # Nothing would reference the result of a job that was reaped or
+    # handed to another worker.  Also renews the lease for the upload.
+    if not app.queue.heartbeat(app.session, worker, [url]):
+        return flask.json.jsonify({'result': 0})
+    stream = bodyStream()
+    try:
+        digest, size = ccLib.Result.storeStream(app.session,
+                    iter(lambda: stream.read(64 * 1024), ''),
+                    app.config['RESULT_MAX_BYTES'])
+    except ValueError:
+        app.session.rollback()
+        flask.abort(413)
+    except IOError:
+        app.session.rollback()
+        flask.abort(400)
+    # Committed on its own so the result is in the DB before the
+    # memory queue logs its hash.
+    app.session.commit()
+    applied = app.queue.applyResults(app.session, worker,
+                [{'op': 'finish', 'url': url, 'hash': digest, 'size': size}])
+    return flask.json.jsonify({'result': applied})
+
+@app.route('/api/export')
+def export():
+    """
+    Stream all completed jobs and their results.
+
+    Query parameters (all optional):
+        format: 'ndjson' (default) or 'csv'
+        gzip: 1 to gzip the output
+        since: only jobs completed at or after this unix timestamp
+        until: only jobs completed before this unix timestamp
+        worker: only jobs completed by this worker
+    """
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'csv'):
+        flask.abort(400)
+    compress = request.args.get('gzip', 0, type=int) == 1
+    # The export holds a server side cursor open for the whole
+    # response so it gets its own session.
+    session = app.session.session_factory()
+
+    def generate():
+        try:
+            for chunk in ccLib.exportResults(session, fmt, compress,
+                        since=request.args.get('since', type=float),
+                        until=request.args.get('until', type=float),
+                        worker=request.args.get('worker')):
+                yield chunk
+        finally:
+            session.close()
+
+    filename = 'results.%s' % fmt
+    mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'text/csv'
+    if compress:
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                headers={'Content-Disposition':
+                         'attachment; filename=%s' % filename})
+
 # def tick():
 #     print('Wakeup Scheduler')
 #     # New thread, so it needs it's own session
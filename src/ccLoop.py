@@ -1,24 +1,69 @@
 """
-A tiny poller that keeps the local cache of AWS workers up to date.
+A tiny poller that keeps the local cache of AWS workers up to date,
+says hello to new workers and returns jobs with expired leases to the
+queue.
 
 Runs a separate process with its own upstart script.
 """
 
 import time
+from concurrent import futures
 
 import ccLib
+import config
+
+def sendHellos(session, executor, workers, backoff):
+    """
+    Say hello to every live worker that hasn't heard from us yet, in
+    parallel, and record the ones that answered in one update.
+
+    A worker that doesn't answer isn't tried again for
+    HELLO_BASE_DELAY seconds, doubling with each further miss up to
+    HELLO_MAX_DELAY.
+
+    @param session: DB access
+    @param executor: futures.Executor -- runs the hellos.
+    @param workers: list of dict -- output of ccLib.getWorkers()
+    @param backoff: dict -- ip to (misses, time of next attempt); kept
+        by the caller between calls.
+    """
+    now = time.time()
+    # It's a live server and we haven't said hello yet.
+    waiting = [w['ip'] for w in workers if not w.get('cc2w') and w.get('ip')]
+    for ip in backoff.keys():
+        if ip not in waiting:
+            del backoff[ip]
+    due = [ip for ip in waiting if backoff.get(ip, (0, 0))[1] <= now]
+    reached = []
+    for ip, answered in zip(due, executor.map(ccLib.Worker.ping, due)):
+        if answered:
+            reached.append(ip)
+            backoff.pop(ip, None)
+        else:
+            misses = backoff.get(ip, (0, 0))[0] + 1
+            delay = min(config.HELLO_MAX_DELAY,
+                        config.HELLO_BASE_DELAY * 2 ** (misses - 1))
+            backoff[ip] = (misses, now + delay)
+    ccLib.Worker.markHello(session, reached)
 
 def main():
-    aws = ccLib.AWS()
+    aws = ccLib.getProvider()
     session = ccLib.initDB()
+    executor = futures.ThreadPoolExecutor(max_workers=config.HELLO_CONCURRENCY)
+    backoff = {}
+    lastReap = 0
 
     while True:
+        # The memory queue reaps its own jobs.
+        if config.QUEUE_BACKEND != 'memory' and \
+                time.time() - lastReap >= config.REAP_INTERVAL:
+            lastReap = time.time()
+            reaped = ccLib.Job.reap(session)
+            if reaped:
+                print('Returned %d abandoned jobs to the queue' % reaped)
         res = ccLib.getWorkers(session, aws)
         print(res)
-        for worker in res:
-            if not worker.get('cc2w') and worker.get('ip'):
-                # It's a live server and we haven't said hello yet.
-                ccLib.Worker.sendHello(session, worker['ip'])
+        sendHellos(session, executor, res, backoff)
         time.sleep(3)
 
 if __name__ == "__main__":
@@ -0,0 +1,211 @@
+"""
+Autoscaler.  Starts and stops workers so the queue drains in about
+SCALE_TARGET_DRAIN seconds without paying for idle instances.
+
+Every SCALE_INTERVAL seconds:
+
+    desired = ceil((queued + running) / (perWorker * SCALE_TARGET_DRAIN))
+
+perWorker, the jobs per second one worker finishes, is measured from
+the done counter while there is a backlog (with an empty queue
+throughput says nothing about capacity).  SCALE_WORKER_RATE is used
+until then.
+
+The desired fleet is spread over the provider's regions within each
+region's limits (SCALE_REGION_LIMITS, else SCALE_MIN_PER_REGION and
+SCALE_MAX_PER_REGION), keeping existing workers where they are.
+Against flapping:
+    * the fleet only shrinks when desired is below SCALE_DOWN_RATIO of
+      its size (hysteresis);
+    * a region grows by at most SCALE_MAX_STEP workers at a time, and
+      not within SCALE_UP_COOLDOWN seconds of its last change;
+    * a region shrinks not within SCALE_DOWN_COOLDOWN seconds of its
+      last change.
+
+Workers are read from the cache kept by ccLoop.py, which must be
+running.  Runs a separate process with its own upstart script
+(scaler.conf).
+"""
+
+import math
+import time
+
+import boto.exception
+import sqlalchemy as DB
+
+import ccLib
+import config
+
+# Worker states that count towards the fleet.
+ACTIVE_STATES = ('pending', 'running')
+
+# Errors from the cloud provider (AWS, or localCloud's processes).
+PROVIDER_ERRORS = (boto.exception.BotoServerError,
+                   boto.exception.BotoClientError, IOError, OSError)
+
+
+class Scaler(object):
+    """
+    Autoscaler state: the throughput estimate and when each region was
+    last changed.
+    """
+    def __init__(self, session, provider):
+        """
+        @param session: DB access.
+        @param provider: ccLib.CloudProvider
+        """
+        self.session = session
+        self.provider = provider
+        self.perWorker = float(config.SCALE_WORKER_RATE)
+        self.lastDone = None  # (time, done counter)
+        self.lastChange = {}  # region: time
+        self.regions = None  # fetched by the first step()
+
+    def limits(self, region):
+        """
+        @returns: tuple (min, max) -- number of workers allowed in the
+            region.
+        """
+        return config.SCALE_REGION_LIMITS.get(region,
+                (config.SCALE_MIN_PER_REGION, config.SCALE_MAX_PER_REGION))
+
+    def observe(self, now, stats, active):
+        """
+        Update the per worker throughput estimate.
+
+        @param now: float -- timestamp of stats.
+        @param stats: dict -- QueueStat counters.
+        @param active: int -- number of running workers.
+        """
+        last = self.lastDone
+        self.lastDone = (now, stats['done'])
+        if last is None or now <= last[0] or not active or not stats['queued']:
+            return
+        rate = (stats['done'] - last[1]) / (now - last[0]) / active
+        alpha = config.SCALE_RATE_SMOOTHING
+        self.perWorker = max(alpha * rate + (1 - alpha) * self.perWorker,
+                             config.SCALE_MIN_WORKER_RATE)
+
+    def desired(self, stats, fleet):
+        """
+        @param stats: dict -- QueueStat counters.
+        @param fleet: int -- current number of workers.
+
+        @returns: int -- the number of workers wanted.
+        """
+        backlog = stats['queued'] + stats['running']
+        want = int(math.ceil(backlog / (self.perWorker * config.SCALE_TARGET_DRAIN)))
+        if want < fleet and want >= fleet * config.SCALE_DOWN_RATIO:
+            # Not enough of a change to be worth shrinking for.
+            return fleet
+        return want
+
+    def plan(self, total, counts):
+        """
+        Spread total workers over the regions.
+
+        @param total: int -- desired fleet size.
+        @param counts: dict -- region to current number of workers.
+
+        @returns: dict -- region to target number of workers.
+        """
+        limits = dict((region, self.limits(region)) for region in counts)
+        targets = dict((region, min(max(n, limits[region][0]), limits[region][1]))
+                       for region, n in counts.items())
+        low = sum(lo for lo, hi in limits.values())
+        high = sum(hi for lo, hi in limits.values())
+        diff = min(max(total, low), high) - sum(targets.values())
+        regions = sorted(targets)
+        while diff > 0:
+            # New workers go where there are fewest.
+            region = min((r for r in regions if targets[r] < limits[r][1]),
+                         key=lambda r: targets[r])
+            targets[region] += 1
+            diff -= 1
+        while diff < 0:
+            region = max((r for r in regions if targets[r] > limits[r][0]),
+                         key=lambda r: targets[r])
+            targets[region] -= 1
+            diff += 1
+        return targets
+
+    def scale(self, region, workers, target, now):
+        """
+        Start or stop workers in a region towards target, subject to
+        the step limit and cooldowns.  The cooldown starts even if the
+        provider fails part way.
+
+        @param region: string -- region id.
+        @param workers: list of dict -- the region's active workers.
+        @param target: int -- wanted number of workers.
+        @param now: float -- timestamp.
+
+        @returns: int -- workers started (negative: stopped).
+        """
+        current = len(workers)
+        since = now - self.lastChange.get(region, 0)
+        if target > current and since >= config.SCALE_UP_COOLDOWN:
+            count = min(target - current, config.SCALE_MAX_STEP)
+            self.lastChange[region] = now
+            for i in range(count):
+                self.provider.startWorker(region)
+            return count
+        if target < current and since >= config.SCALE_DOWN_COOLDOWN:
+            # Stop the least useful first: still booting, then not yet
+            # talking to the CC.
+            workers = sorted(workers, key=lambda w: (w['state'] != 'pending',
+                                                     bool(w['w2cc']), w['awsID']))
+            self.lastChange[region] = now
+            for worker in workers[:current - target]:
+                self.provider.stopWorker(region, worker['awsID'])
+            return target - current
+        return 0
+
+    def step(self):
+        """
+        One round: measure, decide, act.
+        """
+        if self.regions is None:
+            self.regions = [region for region, name in self.provider.getRegions()]
+        now = time.time()
+        stats = ccLib.QueueStat.get(self.session)
+        workers = [w for w in ccLib.Worker.getAll(self.session)
+                   if w['state'] in ACTIVE_STATES]
+        self.session.commit()  # see fresh data next round
+        byRegion = dict((region, []) for region in self.regions)
+        for worker in workers:
+            byRegion.setdefault(worker['region'], []).append(worker)
+
+        active = len([w for w in workers if w['state'] == 'running'])
+        self.observe(now, stats, active)
+        total = self.desired(stats, len(workers))
+        targets = self.plan(total, dict((r, len(ws)) for r, ws in byRegion.items()))
+        print('backlog %d, %.2f jobs/sec per worker: %d workers wanted, %d active'
+              % (stats['queued'] + stats['running'], self.perWorker, total,
+                 len(workers)))
+        for region, target in sorted(targets.items()):
+            try:
+                changed = self.scale(region, byRegion[region], target, now)
+            except PROVIDER_ERRORS as e:
+                # e.g. an instance limit; retried after the cooldown.
+                print('%s: scaling to %d workers failed: %s' % (region, target, e))
+                continue
+            if changed:
+                print('%s: %+d workers (target %d)' % (region, changed, target))
+
+
+def main():
+    session = ccLib.initDB()
+    scaler = Scaler(session, ccLib.getProvider())
+    while True:
+        try:
+            scaler.step()
+        except PROVIDER_ERRORS + (DB.exc.SQLAlchemyError,) as e:
+            # Keep going (and keep the cooldowns) rather than be
+            # respawned without them.
+            print('Scaling round failed: %s' % e)
+            session.rollback()
+        time.sleep(config.SCALE_INTERVAL)
+
+if __name__ == "__main__":
+    main()
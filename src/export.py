@@ -0,0 +1,35 @@
+"""
+Command line export of completed jobs.
+
+Writes every completed job and its result as NDJSON or CSV, streaming
+rows from the DB so memory use stays flat however large the export.
+
+    python export.py --format csv --gzip -o results.csv.gz
+"""
+
+import click
+
+import ccLib
+
+@click.command()
+@click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']),
+              default='ndjson', help='Output format.')
+@click.option('--gzip', 'compress', is_flag=True, help='gzip the output.')
+@click.option('--since', type=float,
+              help='Only jobs completed at or after this unix timestamp.')
+@click.option('--until', type=float,
+              help='Only jobs completed before this unix timestamp.')
+@click.option('--worker', help='Only jobs completed by this worker.')
+@click.option('--output', '-o', type=click.File('wb'), default='-',
+              help='Output file (default stdout).')
+def main(fmt, compress, since, until, worker, output):
+    session = ccLib.initDB()
+    try:
+        for chunk in ccLib.exportResults(session, fmt, compress,
+                        since=since, until=until, worker=worker):
+            output.write(chunk)
+    finally:
+        session.close()
+
+if __name__ == "__main__":
+    main()
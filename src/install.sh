@@ -13,7 +13,9 @@ apt-get install git  -y
 #pyenv
 apt-get install curl git-core gcc make zlib1g-dev libbz2-dev libreadline-dev libsqlite3-dev libssl-dev -y
 
-apt-get install postgresql postgresql-server-dev-9.3 postgresql -y
+# Job claiming uses SELECT ... FOR UPDATE SKIP LOCKED which needs 9.5+.
+# On 14.04 that means adding the apt.postgresql.org repository first.
+apt-get install postgresql-9.5 postgresql-server-dev-9.5 -y
 
 sudu -u postgres bash -c '
 createdb verodin
@@ -21,7 +23,7 @@ createuser --superuser verodin #pretty sure this will promp for password
 '
 
 # change login to trust
-# vim /etc/postgresql/9.3/main/pg_hba.conf
+# vim /etc/postgresql/9.5/main/pg_hba.conf
 /etc/init.d/postgresql restart
 
 git clone https://github.com/nephlm/verodin /opt/verodin
@@ -43,6 +45,8 @@ pyenv virtualenv 2.7.12 verodin '
 # or delete them and have them recreated.
 
 yes | pip install -r /opt/verodin/requirements.txt
+# Building the worker bundle (workerBundle.py) needs pip 8.1+.
+pip install --upgrade 'pip>=8.1'
 
 
 python /tmp/verodin/src/worker/worker.py &
@@ -0,0 +1,248 @@
+"""
+A fake EC2 for load testing the CC without AWS.
+
+Instances are local processes running LOCAL_WORKER_COMMAND (the real
+worker by default), each listening on its own loopback address
+(127.x.y.z), so the CC talks to them exactly as it would to EC2
+workers.  Instance records are JSON files in LOCAL_CLOUD_DIR so the
+web server processes and the poller all see the same fleet.
+
+States follow EC2: pending (booting, LOCAL_BOOT_DELAY), running,
+shutting-down (LOCAL_SHUTDOWN_DELAY) and terminated.  An instance
+whose process dies on its own is reported as stopped.  Records (and
+logs) of stopped and terminated instances are pruned
+LOCAL_PRUNE_DELAY seconds after they ended.
+"""
+
+import fcntl
+import json
+import os
+import random
+import shlex
+import signal
+import subprocess
+import time
+import uuid
+
+import ccLib
+import config
+
+# EC2 instance state codes.
+PENDING = 0
+SHUTTING_DOWN = 32
+STATE_NAMES = {PENDING: 'pending', ccLib.RUNNING: 'running',
+               SHUTTING_DOWN: 'shutting-down', ccLib.STOPPED: 'stopped',
+               ccLib.TERMINATED: 'terminated'}
+
+class LocalProvider(ccLib.CloudProvider):
+    """
+    CloudProvider running workers as processes on this machine.
+    """
+    def __init__(self, root=None):
+        """
+        @param root: string -- directory for instance records; defaults
+            to LOCAL_CLOUD_DIR.
+        """
+        self.root = os.path.abspath(root or config.LOCAL_CLOUD_DIR)
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        self.children = []  # Popen objects to reap
+
+    def lock(self):
+        """
+        @returns: file -- an exclusively locked handle on the registry.
+            Closing it releases the lock.
+        """
+        f = open(os.path.join(self.root, '.lock'), 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def path(self, id):
+        return os.path.join(self.root, '%s.json' % id)
+
+    def load(self):
+        """
+        @returns: list of dict -- every instance record.
+        """
+        instances = []
+        for name in os.listdir(self.root):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.root, name)) as f:
+                    instances.append(json.load(f))
+            except (IOError, ValueError):
+                # Removed or half written under us.
+                pass
+        return instances
+
+    def save(self, instance):
+        tmp = self.path(instance['id']) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(instance, f)
+        os.rename(tmp, self.path(instance['id']))
+
+    def allocateIP(self, instances):
+        """
+        @param instances: list of dict -- current instance records.
+
+        @returns: string -- a loopback address no instance is using.
+        """
+        used = set(i['ip'] for i in instances)
+        while True:
+            n = random.randint(1, 254 * 254 * 254)
+            ip = '127.%d.%d.%d' % (n // 64516 + 1, n // 254 % 254 + 1, n % 254 + 1)
+            if ip not in used:
+                return ip
+
+    def state(self, instance, now):
+        """
+        @param instance: dict -- instance record.
+        @param now: float -- current time.
+
+        @returns: int -- EC2 state code of the instance.
+        """
+        if instance.get('terminated'):
+            if now - instance['terminated'] < config.LOCAL_SHUTDOWN_DELAY:
+                return SHUTTING_DOWN
+            return ccLib.TERMINATED
+        if now < instance['launched'] + instance['bootDelay']:
+            return PENDING
+        if instance.get('stopped') or not alive(instance['pid']):
+            return ccLib.STOPPED
+        return ccLib.RUNNING
+
+    def prune(self, now):
+        """
+        Note when instances were first seen stopped, and remove the
+        records and logs of instances that stopped or terminated more
+        than LOCAL_PRUNE_DELAY seconds ago.
+
+        @param now: float -- current time.
+
+        @returns: list of dict -- the remaining instance records.
+        """
+        lock = self.lock()
+        try:
+            kept = []
+            for instance in self.load():
+                ended = instance.get('terminated') or instance.get('stopped')
+                if not ended and self.state(instance, now) == ccLib.STOPPED:
+                    ended = instance['stopped'] = now
+                    self.save(instance)
+                if ended and now - ended > config.LOCAL_PRUNE_DELAY:
+                    for path in (self.path(instance['id']),
+                                 os.path.join(self.root, '%s.log' % instance['id'])):
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+                    continue
+                kept.append(instance)
+            return kept
+        finally:
+            lock.close()
+
+    def getRegions(self):
+        time.sleep(config.LOCAL_API_LATENCY)
+        return sorted(config.LOCAL_REGIONS.items())
+
+    def startWorker(self, region):
+        """
+        Start a worker process in the (pretend) region.  It sits out
+        its boot delay before the worker command runs.
+
+        @param region: string -- one of LOCAL_REGIONS.
+        """
+        time.sleep(config.LOCAL_API_LATENCY)
+        bootDelay = random.uniform(*config.LOCAL_BOOT_DELAY)
+        lock = self.lock()
+        try:
+            instance = {'id': 'i-%s' % uuid.uuid4().hex[:8],
+                        'region': region,
+                        'ip': self.allocateIP(self.load()),
+                        'launched': time.time(),
+                        'bootDelay': bootDelay,
+                        'terminated': None}
+            env = dict(os.environ,
+                       VERODIN_WORKER_IP=instance['ip'],
+                       VERODIN_CC_IP=config.LOCAL_CC_IP)
+            log = open(os.path.join(self.root, '%s.log' % instance['id']), 'a')
+            command = ['sh', '-c', 'sleep %f; exec "$@"' % bootDelay, 'boot'] + \
+                shlex.split(config.LOCAL_WORKER_COMMAND)
+            child = subprocess.Popen(command, env=env, stdout=log,
+                                     stderr=subprocess.STDOUT,
+                                     preexec_fn=os.setsid)
+            log.close()
+            self.children.append(child)
+            instance['pid'] = child.pid
+            self.save(instance)
+        finally:
+            lock.close()
+
+    def stopWorker(self, region, id):
+        """
+        Terminate the worker process of the given instance.
+
+        @param region: string -- region of the instance.
+        @param id: string -- instance id.
+        """
+        time.sleep(config.LOCAL_API_LATENCY)
+        lock = self.lock()
+        try:
+            for instance in self.load():
+                if instance['id'] == id and not instance['terminated']:
+                    instance['terminated'] = time.time()
+                    try:
+                        os.killpg(instance['pid'], signal.SIGTERM)
+                    except OSError:
+                        pass  # already gone
+                    self.save(instance)
+        finally:
+            lock.close()
+
+    def getWorkers(self):
+        """
+        Retrieve the local instances that aren't stopped or
+        terminated.  Prunes old records, see prune().
+
+        @returns: list of dict.  See AWS.getWorkers.
+        """
+        time.sleep(config.LOCAL_API_LATENCY)
+        self.children = [c for c in self.children if c.poll() is None]
+        now = time.time()
+        ret = []
+        for instance in self.prune(now):
+            state = self.state(instance, now)
+            if state in (ccLib.TERMINATED, ccLib.STOPPED):
+                continue
+            ret.append({'awsID': instance['id'],
+                        # Like EC2, the address goes away on shutdown.
+                        'ip': None if state == SHUTTING_DOWN else instance['ip'],
+                        'state': STATE_NAMES[state],
+                        'state_code': state,
+                        'region': instance['region'],
+                        'region_human': config.LOCAL_REGIONS.get(
+                            instance['region'], instance['region'])})
+        return ret
+
+def alive(pid):
+    """
+    @param pid: int -- process id.
+
+    @returns: bool -- the process exists and hasn't exited.  A worker
+        that exited stays a zombie until the CC process that started
+        it reaps it, and signals still reach zombies, so /proc is
+        checked too.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            # Fields after the command: state ppid ...
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (IOError, IndexError):
+        # No /proc here; kill is all there is.
+        return True
@@ -0,0 +1,960 @@
+"""
+In-process job queue (QUEUE_BACKEND = 'memory').
+
+MemQueue implements the JobQueue operations (see ccLib) on structures
+in memory instead of the job table, so claiming is a heap pop under a
+lock rather than a locked, committed transaction:
+
+    jobs -- every unfinished job (and finished ones not yet
+        checkpointed) by url.
+    ready -- a heap of claimable jobs by submit time for each host.
+    hostHeap -- hosts that may be claimed from, by their oldest
+        claimable job.  Hosts at their HOST_MAX_IN_FLIGHT or
+        HOST_MAX_RATE limit are parked instead, until a job of theirs
+        is released or their next_claim comes, so claims never wade
+        through the jobs of hosts they can't take from.
+    delayed -- heap of failed jobs waiting out their retry backoff.
+    inFlight -- claimed jobs by url.
+    dead -- jobs given up on, by url.
+    hosts -- in flight count and rate limit of each host, as Host.
+
+It only works when a single process serves the CC (gunicorn.conf
+starts one for this backend); a second process fails to start rather
+than run a queue of its own.
+
+Every change is appended to a write ahead log (numbered JSON lines in
+MEM_QUEUE_DIR) before the call returns.  Records are numbered and
+queued under the lock but encoded and written outside it, by whichever
+caller gets to the log first, together with the records queued by the
+others meanwhile (group commit).  Every MEM_QUEUE_CHECKPOINT
+seconds the changed jobs, their results, the hosts and the counters
+are written to the job, result, host and queue_stat tables in one
+transaction, together with the number of the last log record they
+include (QueueCheckpoint).  The log segments that are covered are
+then deleted and finished jobs leave memory; adding a URL checks the
+job table for those.  On startup the unfinished jobs are loaded from
+the job table and the log records after the checkpoint are replayed.
+
+Heartbeats are not logged; after a restart every in-flight job gets a
+fresh lease.
+"""
+
+import fcntl
+import glob
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import sqlalchemy as DB
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import sessionmaker
+
+import ccLib
+import config
+import metrics
+
+# QueueCheckpoint.name of this queue.
+CHECKPOINT_NAME = 'memory'
+
+# Job table columns kept in memory and written by checkpoints.
+COLUMNS = ('url', 'host', 'submit', 'start', 'complete', 'worker',
+           'lease_expires', 'attempts', 'not_before', 'dead', 'error',
+           'result_hash', 'result_size')
+
+# Rows per statement when checkpointing.
+CHUNK = 500
+
+
+class MemJob(object):
+    """
+    A job in memory, with the fields of a job table row.  `result` is
+    the body of a finished job until it is checkpointed (unless it was
+    streamed and so stored already, see result_hash); `ticket`
+    identifies the job's current entry in the ready or delayed heap
+    (entries with another ticket are stale and skipped).
+    """
+    __slots__ = COLUMNS + ('result', 'ticket')
+
+    def __init__(self, url, submit):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        self.url = url
+        self.host = ccLib.Host.of(url)
+        self.submit = submit
+        self.attempts = 0
+
+    def row(self):
+        """
+        @returns: dict -- job table columns to values.
+        """
+        return dict((name, getattr(self, name)) for name in COLUMNS)
+
+
+class Notifier(ccLib.JobNotifier):
+    """
+    JobNotifier woken directly by the MemQueue of this process
+    instead of by a postgres listener.
+    """
+    def __init__(self):
+        ccLib.JobNotifier.__init__(self, None)
+
+    def start(self):
+        pass
+
+
+class MemQueue(ccLib.JobQueue):
+    """
+    JobQueue kept in memory, see the module docstring.  The session
+    passed to the operations is only used to check the job table for
+    duplicates in add() and by delete().
+    """
+    def __init__(self, engine, root=None):
+        """
+        @param engine: DB engine to load from and checkpoint to.
+        @param root: string -- directory for the log; defaults to
+            MEM_QUEUE_DIR.
+        """
+        self.engine = engine
+        self.Session = sessionmaker(bind=engine)
+        self.root = os.path.abspath(root or config.MEM_QUEUE_DIR)
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        self.lockFile = open(os.path.join(self.root, '.lock'), 'a')
+        try:
+            fcntl.flock(self.lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            raise RuntimeError('The memory queue in %s is in use by another '
+                               'process.  Serve the CC from a single process '
+                               '(gunicorn --workers 1).' % self.root)
+        # Lock order: checkpointLock, addLock, walLock, lock.
+        self.lock = threading.Lock()  # queue state and pending
+        self.addLock = threading.Lock()  # duplicate checks, see _insert
+        self.walLock = threading.Lock()  # the log file, see sync
+        self.checkpointLock = threading.Lock()
+        self.notifier = Notifier()
+        self.reset()
+        self.wal = None  # file descriptor of the open segment
+        self.walPath = None
+        self.walSize = 0  # bytes of whole records in it
+        self.pending = []  # (seq, now, op, args) not written yet
+        self.recover()
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def reset(self):
+        """
+        Empty the in memory state.
+        """
+        self.jobs = {}
+        self.ready = {}  # host: heap of (submit, ticket, url)
+        self.hostHeap = []  # (submit, ticket, host)
+        self.hostKey = {}  # host: (submit, ticket) of its hostHeap entry
+        self.parked = set()  # hosts at a limit, not in hostHeap
+        self.waiting = []  # (next_claim, host) of hosts parked for the rate
+        self.delayed = []  # (not_before, ticket, url)
+        self.inFlight = {}
+        self.dead = {}
+        self.hosts = {}  # name: [in_flight, next_claim]
+        self.stats = dict((name, 0) for name in ccLib.QueueStat.NAMES)
+        self.dirty = set()  # urls changed since the last checkpoint
+        self.tickets = itertools.count()
+
+    #===================================
+    # Write ahead log
+
+    def segmentPath(self, start):
+        return os.path.join(self.root, 'wal.%020d' % start)
+
+    def segments(self):
+        """
+        @returns: list of strings -- paths of the log segments, oldest
+            first.
+        """
+        return sorted(glob.glob(os.path.join(self.root, 'wal.*')))
+
+    def log(self, now, op, args):
+        """
+        Queue a record for the log.  Call with self.lock held, before
+        applying the change, and sync() the record once self.lock is
+        released, before the call returns.
+
+        @param now: float -- time of the operation; replayed with it.
+        @param op: string -- operation, see apply().
+        @param args: dict -- its arguments, JSON encodable.  Encoded
+            when written, so don't change them afterwards.
+
+        @returns: int -- the number of the record.
+        """
+        self.seq += 1
+        self.pending.append((self.seq, now, op, args))
+        return self.seq
+
+    def sync(self, seq):
+        """
+        Write the queued records to the log, up to record seq at least.
+        Call without self.lock held.  Records queued by other threads
+        meanwhile go in the same write (and fsync), so under load one
+        write covers many operations.
+
+        @raises IOError, OSError: if the write failed.  The records
+            stay queued for the next write; their changes are applied,
+            so the next checkpoint saves them in any case.
+        """
+        with self.walLock:
+            with self.lock:
+                if self.written >= seq or not self.pending:
+                    return
+                records = self.pending
+                self.pending = []
+            try:
+                self.write(records)
+            except (IOError, OSError):
+                with self.lock:
+                    self.pending = records + self.pending
+                raise
+
+    def write(self, records):
+        """
+        Append records to the log.  Call with self.walLock held.  A
+        failed write is cut off again, so the segment never holds a
+        partial record followed by whole ones (replay stops a segment
+        at its first partial record); if that fails as well the next
+        write starts a new segment.
+        """
+        if self.wal is None:
+            self.walPath = self.segmentPath(records[0][0])
+            self.wal = os.open(self.walPath,
+                               os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+            self.walSize = 0
+        data = ''.join('[%d, %r, "%s", %s]\n' % (seq, now, op, json.dumps(args))
+                       for seq, now, op, args in records)
+        try:
+            written = 0
+            while written < len(data):
+                written += os.write(self.wal, data[written:])
+            if config.MEM_QUEUE_FSYNC:
+                os.fsync(self.wal)
+        except (IOError, OSError):
+            try:
+                os.ftruncate(self.wal, self.walSize)
+                os.lseek(self.wal, self.walSize, os.SEEK_SET)
+            except OSError:
+                self.closeSegment()
+            raise
+        self.walSize += len(data)
+        self.written = records[-1][0]
+
+    def closeSegment(self):
+        if self.wal is not None:
+            try:
+                os.close(self.wal)
+            except OSError:
+                pass
+        self.wal = None
+        self.walPath = None
+
+    def rotate(self):
+        """
+        Close the current log segment, unless it is still empty; the
+        next write starts a new one.  Call with self.walLock and
+        self.lock held.
+
+        @returns: list of strings -- paths of the closed segments.
+        """
+        if self.walSize:
+            self.closeSegment()
+        return [p for p in self.segments() if p != self.walPath]
+
+    def apply(self, op, now, args):
+        """
+        Apply a logged operation.
+
+        @param op: string -- 'add', 'claim', 'results', 'reap' or
+            'requeue'.
+        @param now: float -- the time of the operation.
+        @param args: dict -- its arguments.
+        """
+        if op == 'add':
+            self._add(now, args['urls'])
+        elif op == 'claim':
+            self._claim(now, args['worker'], args['urls'])
+        elif op == 'results':
+            self._results(now, args['worker'], args['results'])
+        elif op == 'reap':
+            self._reap(args['urls'])
+        elif op == 'requeue':
+            self._requeue(now)
+
+    #===================================
+    # Recovery and checkpoints
+
+    def recover(self):
+        """
+        Load the unfinished jobs from the DB and replay the log records
+        after the last checkpoint.
+        """
+        Job = ccLib.Job
+        session = self.Session()
+        try:
+            self.checkpointed = ccLib.QueueCheckpoint.get(session, CHECKPOINT_NAME)
+            stats = ccLib.QueueStat.get(session)
+            self.stats['done'] = stats['done']
+            self.stats['failed'] = stats['failed']
+            for host in session.query(ccLib.Host):
+                self.hosts[host.name] = [0, host.next_claim]
+            query = session.query(*[getattr(Job, name) for name in COLUMNS]).\
+                filter(Job.complete == None)
+            for row in query.yield_per(10000):
+                job = MemJob(row.url, row.submit)
+                for name in COLUMNS:
+                    setattr(job, name, getattr(row, name))
+                self.load(job)
+        finally:
+            session.close()
+
+        self.seq = self.checkpointed
+        for path in self.segments():
+            with open(path) as f:
+                for line in f:
+                    try:
+                        seq, now, op, args = json.loads(line)
+                    except ValueError:
+                        # Torn write; the process died mid record.
+                        break
+                    if seq <= self.checkpointed:
+                        continue
+                    self.apply(op, now, args)
+                    self.seq = seq
+        lease = time.time() + config.LEASE_SECONDS
+        for job in self.inFlight.values():
+            job.lease_expires = max(job.lease_expires, lease)
+        # New records go to a new segment, after any torn tail.
+        self.written = self.seq
+        print('Memory queue: %(queued)d queued, %(running)d running, '
+              '%(dead)d dead' % self.stats)
+
+    def load(self, job):
+        """
+        Add a job loaded from the job table.
+        """
+        self.jobs[job.url] = job
+        host = self.hosts.setdefault(job.host, [0, 0])
+        if job.start is not None:
+            job.lease_expires = time.time() + config.LEASE_SECONDS
+            self.inFlight[job.url] = job
+            host[0] += 1
+            self.stats['running'] += 1
+        elif job.dead is not None:
+            self.dead[job.url] = job
+            self.stats['dead'] += 1
+        else:
+            self.enqueue(job)
+            self.stats['queued'] += 1
+
+    def checkpoint(self):
+        """
+        Write the changes since the last checkpoint to the DB and drop
+        the log segments and finished jobs it covers.
+
+        @returns: bool -- False if the DB write failed; the changes are
+            kept for the next checkpoint.
+        """
+        with self.checkpointLock:
+            with self.walLock, self.lock:
+                if not self.dirty and self.seq == self.checkpointed:
+                    return True
+                seq = self.seq
+                urls = self.dirty
+                self.dirty = set()
+                jobs = [self.jobs[url] for url in urls if url in self.jobs]
+                rows = [job.row() for job in jobs]
+                bodies = [job.result for job in jobs]
+                hosts = [{'name': name, 'in_flight': h[0], 'next_claim': h[1]}
+                         for name, h in self.hosts.items()]
+                stats = dict(self.stats)
+                # Records up to seq not written yet go in the next
+                # segment; replay skips them once this checkpoint is in.
+                closed = self.rotate()
+
+            session = self.Session()
+            try:
+                for i in range(0, len(rows), CHUNK):
+                    refs = ccLib.Result.storeMany(session, bodies[i:i + CHUNK])
+                    for row, (digest, size) in zip(rows[i:i + CHUNK], refs):
+                        if digest is not None:
+                            row['result_hash'] = digest
+                            row['result_size'] = size
+                    session.execute(upsert(ccLib.Job, ['url'], rows[i:i + CHUNK]))
+                for i in range(0, len(hosts), CHUNK):
+                    session.execute(upsert(ccLib.Host, ['name'], hosts[i:i + CHUNK]))
+                ccLib.QueueStat.set(session, **stats)
+                ccLib.QueueCheckpoint.set(session, CHECKPOINT_NAME, seq)
+                session.commit()
+            except DB.exc.SQLAlchemyError as e:
+                print('Memory queue checkpoint failed: %s' % e)
+                session.rollback()
+                with self.lock:
+                    self.dirty |= urls
+                return False
+            finally:
+                session.close()
+
+            for path in closed:
+                os.remove(path)
+            with self.addLock:
+                with self.lock:
+                    self.checkpointed = seq
+                    for job in jobs:
+                        if job.complete is not None and job.url not in self.dirty:
+                            del self.jobs[job.url]
+            return True
+
+    def run(self):
+        """
+        Background thread: checkpoints, and reaps expired leases (the
+        poller's reaper only works on the job table).
+        """
+        lastReap = 0
+        while True:
+            time.sleep(config.MEM_QUEUE_CHECKPOINT)
+            if time.time() - lastReap >= config.REAP_INTERVAL:
+                lastReap = time.time()
+                reaped = self.reap(None)
+                if reaped:
+                    print('Returned %d abandoned jobs to the queue' % reaped)
+            self.checkpoint()
+
+    #===================================
+    # Queue state.  The underscore methods apply one logged operation;
+    # call them with self.lock held.
+
+    def enqueue(self, job):
+        """
+        Put a job in the ready heap, or the delayed heap while it waits
+        out a retry backoff.
+        """
+        job.ticket = next(self.tickets)
+        if job.not_before is not None:
+            heapq.heappush(self.delayed, (job.not_before, job.ticket, job.url))
+        else:
+            self.push((job.submit, job.ticket, job.url), job.host)
+
+    def push(self, entry, host):
+        """
+        Put an entry in the ready heap of its host, scheduling the host
+        if the entry is its oldest.
+        """
+        heapq.heappush(self.ready.setdefault(host, []), entry)
+        key = self.hostKey.get(host)
+        if host not in self.parked and (key is None or entry[0] < key[0]):
+            self.schedule(host)
+
+    def schedule(self, host):
+        """
+        (Re)enter a host in hostHeap by its oldest ready job.  Any
+        earlier entry of the host becomes stale.
+        """
+        heap = self.ready.get(host)
+        while heap and self.current(heap[0]) is None:
+            heapq.heappop(heap)
+        if not heap:
+            self.ready.pop(host, None)
+            self.hostKey.pop(host, None)
+            return
+        key = self.hostKey[host] = (heap[0][0], next(self.tickets))
+        heapq.heappush(self.hostHeap, key + (host,))
+
+    def park(self, host, nextClaim=None):
+        """
+        Take a host at a limit out of hostHeap.
+
+        @param nextClaim: float or None -- when the host is under its
+            rate limit again; None if it is at its in flight limit.
+        """
+        self.hostKey.pop(host, None)
+        self.parked.add(host)
+        if nextClaim is not None:
+            heapq.heappush(self.waiting, (nextClaim, host))
+
+    def unpark(self, host):
+        if host in self.parked:
+            self.parked.discard(host)
+            self.schedule(host)
+
+    def current(self, entry):
+        """
+        @param entry: tuple -- a ready or delayed heap entry.
+
+        @returns: MemJob or None if the entry is stale.
+        """
+        job = self.jobs.get(entry[2])
+        if job is not None and job.ticket == entry[1]:
+            return job
+        return None
+
+    def promote(self, now):
+        """
+        Move jobs whose backoff is over to the ready heap.
+        """
+        while self.delayed and self.delayed[0][0] <= now:
+            job = self.current(heapq.heappop(self.delayed))
+            if job is not None:
+                job.ticket = next(self.tickets)
+                self.push((job.submit, job.ticket, job.url), job.host)
+
+    def bump(self, **deltas):
+        for name, delta in deltas.items():
+            self.stats[name] += delta
+
+    def release(self, hosts):
+        for name, n in Counter(hosts).items():
+            host = self.hosts.setdefault(name, [0, 0])
+            host[0] = max(host[0] - n, 0)
+            if host[0] < config.HOST_MAX_IN_FLIGHT:
+                self.unpark(name)
+
+    def select(self, now, count):
+        """
+        Pick up to count jobs to claim, like Job.claimBatch: hosts in
+        the order of their oldest job, each giving as many as its
+        HOST_MAX_IN_FLIGHT and HOST_MAX_RATE limits allow, grouped by
+        host.  Hosts found at a limit are parked.  The picked entries
+        are popped from the ready heaps.
+
+        @returns: list of heap entries.
+        """
+        self.promote(now)
+        while self.waiting and self.waiting[0][0] <= now:
+            self.unpark(heapq.heappop(self.waiting)[1])
+        picked = OrderedDict()  # host: entries
+        taken = 0
+        while self.hostHeap and taken < count:
+            submit, ticket, name = heapq.heappop(self.hostHeap)
+            if self.hostKey.get(name) != (submit, ticket):
+                continue  # stale
+            heap = self.ready.get(name)
+            while heap and self.current(heap[0]) is None:
+                heapq.heappop(heap)
+            if not heap or heap[0][0] != submit:
+                # Its oldest job went; enter it again by the next one.
+                self.schedule(name)
+                continue
+            del self.hostKey[name]
+            inFlight, nextClaim = self.hosts.get(name, (0, 0))
+            if inFlight >= config.HOST_MAX_IN_FLIGHT:
+                self.park(name)
+                continue
+            if nextClaim > now:
+                self.park(name, nextClaim)
+                continue
+            allowance = min(count - taken, config.HOST_MAX_IN_FLIGHT - inFlight)
+            entries = picked[name] = []
+            while heap and len(entries) < allowance:
+                entry = heapq.heappop(heap)
+                if self.current(entry) is not None:
+                    entries.append(entry)
+            taken += len(entries)
+        for name in picked:
+            # Checked against its limits again by the next select.
+            self.schedule(name)
+        return [entry for entries in picked.values() for entry in entries]
+
+    def _add(self, now, urls):
+        for url in urls:
+            if url in self.jobs:
+                continue
+            job = MemJob(url, now)
+            self.jobs[url] = job
+            self.hosts.setdefault(job.host, [0, 0])
+            self.enqueue(job)
+            self.dirty.add(url)
+            self.stats['queued'] += 1
+
+    def _claim(self, now, worker, urls):
+        taken = Counter()
+        for url in urls:
+            job = self.jobs.get(url)
+            if job is None or job.start is not None or job.dead is not None:
+                continue
+            job.start = now
+            job.worker = worker
+            job.lease_expires = now + config.LEASE_SECONDS
+            job.ticket = None
+            self.inFlight[url] = job
+            self.dirty.add(url)
+            taken[job.host] += 1
+        for name, n in taken.items():
+            host = self.hosts.setdefault(name, [0, 0])
+            host[0] += n
+            if config.HOST_MAX_RATE:
+                host[1] = max(host[1], now) + float(n) / config.HOST_MAX_RATE
+        claimed = sum(taken.values())
+        self.bump(queued=-claimed, running=claimed)
+
+    def _results(self, now, worker, results):
+        """
+        @returns: tuple (applied, requeued) -- numbers of reports
+            applied and of failed jobs put back in the queue.
+        """
+        released = []
+        finished = 0
+        failed = 0
+        dead = 0
+        for result in results:
+            job = self.inFlight.get(result.get('url'))
+            if job is None or job.worker != worker:
+                continue
+            del self.inFlight[job.url]
+            released.append(job.host)
+            job.lease_expires = None
+            if result.get('op') == 'finish':
+                job.complete = now
+                if result.get('hash'):
+                    # Stored already (Result.storeStream).
+                    job.result_hash = result['hash']
+                    job.result_size = result.get('size')
+                else:
+                    job.result = result.get('data')
+                finished += 1
+            else:
+                job.submit = now
+                job.start = None
+                job.worker = None
+                job.attempts = (job.attempts or 0) + 1
+                job.error = ccLib.Job.errorText(result.get('data'))
+                if job.attempts >= config.MAX_ATTEMPTS:
+                    job.dead = now
+                    self.dead[job.url] = job
+                    dead += 1
+                else:
+                    job.not_before = now + min(config.RETRY_MAX_DELAY,
+                        config.RETRY_BASE_DELAY * 2 ** (job.attempts - 1))
+                    self.enqueue(job)
+                failed += 1
+            self.dirty.add(job.url)
+        self.release(released)
+        self.bump(running=-(finished + failed), done=finished,
+                  queued=failed - dead, failed=failed, dead=dead)
+        return finished + failed, failed - dead
+
+    def _reap(self, urls):
+        released = []
+        for url in urls:
+            job = self.inFlight.pop(url, None)
+            if job is None:
+                continue
+            job.start = None
+            job.worker = None
+            job.lease_expires = None
+            self.enqueue(job)
+            self.dirty.add(url)
+            released.append(job.host)
+        self.release(released)
+        self.bump(running=-len(released), queued=len(released))
+
+    def _requeue(self, now):
+        count = 0
+        for job in self.dead.values():
+            job.dead = None
+            job.attempts = 0
+            job.not_before = None
+            job.submit = now
+            self.enqueue(job)
+            self.dirty.add(job.url)
+            count += 1
+        self.dead = {}
+        self.bump(dead=-count, queued=count)
+        return count
+
+    #===================================
+    # JobQueue operations
+
+    def add(self, session, urls, chunkSize=5000):
+        """
+        See Job.add.
+        """
+        inserted = 0
+        duplicates = 0
+        chunk = []
+        for url in urls:
+            url = url.strip()
+            if url:
+                chunk.append(url)
+            if len(chunk) >= chunkSize:
+                added = self._insert(session, chunk)
+                inserted += added
+                duplicates += len(chunk) - added
+                chunk = []
+        if chunk:
+            added = self._insert(session, chunk)
+            inserted += added
+            duplicates += len(chunk) - added
+        return {'inserted': inserted, 'duplicates': duplicates}
+
+    def _insert(self, session, urls):
+        """
+        Add one chunk of URLs for add().
+
+        Finished jobs are only in the job table once checkpointed, so
+        that is checked too.  addLock keeps checkpoints from dropping a
+        finished job from memory between the two checks.
+
+        @returns: int -- number of URLs actually added.
+        """
+        with self.addLock:
+            Job = ccLib.Job
+            known = set(url for (url,) in
+                        session.query(Job.url).filter(Job.url.in_(urls)))
+            session.commit()
+            with self.lock:
+                new = []
+                for url in urls:
+                    if url not in known and url not in self.jobs:
+                        known.add(url)
+                        new.append(url)
+                if new:
+                    now = time.time()
+                    seq = self.log(now, 'add', {'urls': new})
+                    self._add(now, new)
+        if new:
+            self.sync(seq)
+            self.notifier.wake()
+        return len(new)
+
+    def claim(self, session, worker):
+        """
+        See Job.claim.
+        """
+        urls = self.claimBatch(session, worker, 1)
+        if urls:
+            return urls[0]
+        return None
+
+    def claimBatch(self, session, worker, count):
+        """
+        See Job.claimBatch.
+        """
+        started = time.time()
+        with self.lock:
+            now = time.time()
+            entries = self.select(now, count)
+            metrics.CLAIM_QUERY_TIME.observe(time.time() - started,
+                                             backend='memory')
+            if not entries:
+                return []
+            urls = [entry[2] for entry in entries]
+            seq = self.log(now, 'claim', {'worker': worker, 'urls': urls})
+            self._claim(now, worker, urls)
+        self.sync(seq)
+        return urls
+
+    def finishJob(self, session, url, worker, data):
+        """
+        See Job.finishJob.
+        """
+        self.applyResults(session, worker,
+                    [{'op': 'finish', 'url': url, 'data': data}])
+
+    def failJob(self, session, url, worker, data):
+        """
+        See Job.failJob.
+        """
+        self.applyResults(session, worker,
+                    [{'op': 'fail', 'url': url, 'data': data}])
+
+    def applyResults(self, session, worker, results):
+        """
+        See Job.applyResults.
+        """
+        results = [r for r in results if r.get('url')]
+        if not results:
+            return 0
+        with self.lock:
+            now = time.time()
+            seq = self.log(now, 'results', {'worker': worker, 'results': results})
+            applied, requeued = self._results(now, worker, results)
+        self.sync(seq)
+        if requeued:
+            self.notifier.wake()
+        return applied
+
+    def heartbeat(self, session, worker, urls):
+        """
+        See Job.heartbeat.
+        """
+        extended = 0
+        with self.lock:
+            lease = time.time() + config.LEASE_SECONDS
+            for url in urls or ():
+                job = self.inFlight.get(url)
+                if job is not None and job.worker == worker:
+                    job.lease_expires = lease
+                    extended += 1
+        return extended
+
+    def reap(self, session):
+        """
+        See Job.reap.  Called by the background thread.
+        """
+        with self.lock:
+            now = time.time()
+            urls = [url for url, job in self.inFlight.items()
+                    if job.lease_expires < now]
+            if urls:
+                seq = self.log(now, 'reap', {'urls': urls})
+                self._reap(urls)
+        if urls:
+            self.sync(seq)
+            self.notifier.wake()
+        return len(urls)
+
+    def getDead(self, session, count=None):
+        """
+        See Job.getDead.
+        """
+        with self.lock:
+            if count:
+                jobs = heapq.nlargest(count, self.dead.values(),
+                                      key=lambda job: job.dead)
+            else:
+                jobs = sorted(self.dead.values(), key=lambda job: job.dead,
+                              reverse=True)
+        return [{'url': j.url, 'attempts': j.attempts, 'dead': j.dead,
+                 'error': j.error}
+                for j in jobs]
+
+    def requeueDead(self, session):
+        """
+        See Job.requeueDead.
+        """
+        with self.lock:
+            if not self.stats['dead']:
+                return 0
+            now = time.time()
+            seq = self.log(now, 'requeue', {})
+            count = self._requeue(now)
+        self.sync(seq)
+        if count:
+            self.notifier.wake()
+        return count
+
+    def getJobs(self, session, count=None):
+        """
+        See Job.getJobs.  Jobs waiting out a retry backoff are listed
+        with the ready ones, by submit time; with count, the count of
+        them that are due soonest.
+        """
+        with self.lock:
+            if count:
+                jobs = self.head(count) + self.headDelayed(count)
+            else:
+                jobs = [self.current(entry) for heap in self.ready.values()
+                        for entry in heap]
+                jobs += [self.current(entry) for entry in self.delayed]
+            jobs = [{'url': j.url, 'submit': j.submit} for j in jobs if j]
+            stats = dict(self.stats)
+        jobs.sort(key=lambda j: j['submit'])
+        if count:
+            jobs = jobs[:count]
+        return {'cnt': stats['queued'], 'running': stats['running'],
+                'done': stats['done'], 'failed': stats['failed'],
+                'dead': stats['dead'], 'jobs': jobs}
+
+    def head(self, count):
+        """
+        The first count current ready jobs, without popping them: a
+        walk down hostHeap, and the heaps of the hosts it reaches (and
+        of the parked hosts), in order.  O(count log count), plus the
+        parked hosts.
+
+        @returns: list of MemJob
+        """
+        ret = []
+        frontier = []  # (entry, index, heap)
+        def follow(heap, i):
+            if i < len(heap):
+                heapq.heappush(frontier, (heap[i], i, heap))
+        follow(self.hostHeap, 0)
+        for name in self.parked:
+            follow(self.ready.get(name, ()), 0)
+        while frontier and len(ret) < count:
+            entry, i, heap = heapq.heappop(frontier)
+            follow(heap, 2 * i + 1)
+            follow(heap, 2 * i + 2)
+            if heap is self.hostHeap:
+                # A host entry's submit is never after the host's
+                # oldest job, so its jobs come out in order.
+                if self.hostKey.get(entry[2]) == entry[:2]:
+                    follow(self.ready.get(entry[2], ()), 0)
+            else:
+                job = self.current(entry)
+                if job is not None:
+                    ret.append(job)
+        return ret
+
+    def headDelayed(self, count):
+        """
+        The first count current jobs of the delayed heap, without
+        popping them, like head().
+
+        @returns: list of MemJob
+        """
+        ret = []
+        frontier = [(self.delayed[0], 0)] if self.delayed else []
+        while frontier and len(ret) < count:
+            entry, i = heapq.heappop(frontier)
+            job = self.current(entry)
+            if job is not None:
+                ret.append(job)
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(self.delayed):
+                    heapq.heappush(frontier, (self.delayed[child], child))
+        return ret
+
+    def getStats(self, session):
+        """
+        See Job.getStats.
+        """
+        with self.lock:
+            return dict(self.stats)
+
+    def delete(self, session):
+        """
+        See Job.delete.  Takes effect in the DB immediately.
+        """
+        with self.checkpointLock:
+            with self.addLock, self.walLock, self.lock:
+                session.query(ccLib.Job).delete()
+                session.query(ccLib.Result).delete()
+                session.query(ccLib.Host).delete()
+                ccLib.QueueStat.reset(session)
+                ccLib.QueueCheckpoint.set(session, CHECKPOINT_NAME, self.seq)
+                session.commit()
+                session.expire_all()
+                self.reset()
+                self.checkpointed = self.seq
+                for path in self.rotate():
+                    os.remove(path)
+
+    def getNotifier(self, engine):
+        return self.notifier
+
+
+def upsert(model, keys, rows):
+    """
+    @param model: ORM model class.
+    @param keys: list of strings -- the unique columns rows conflict on.
+    @param rows: list of dict -- column values, all with the same keys.
+
+    @returns: INSERT ... ON CONFLICT DO UPDATE statement writing rows.
+    """
+    stmt = postgresql.insert(model.__table__).values(rows)
+    return stmt.on_conflict_do_update(index_elements=keys,
+                set_=dict((name, stmt.excluded[name])
+                          for name in rows[0] if name not in keys))
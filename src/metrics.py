@@ -0,0 +1,310 @@
+"""
+Minimal Prometheus metrics for the CC.
+
+Counters, gauges and histograms are kept in process memory and
+rendered in the Prometheus text format by render() (served at
+/metrics by cc.py).  Recording is a lock, a dict lookup and, for
+histograms, a bisect, so it is cheap enough for every request.
+
+Values live in the process that records them.  Under gunicorn with
+several worker processes, share() makes each process write its values
+to a file in a directory every second, and render() adds up the
+files of all processes, so whichever process answers a scrape reports
+the whole CC.  Counters and histograms include processes that have
+since exited (a restarted worker doesn't make them go backwards);
+gauges only count running processes.
+"""
+
+import bisect
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+REGISTRY = []
+
+# Directory shared with the other CC processes, see share().
+SHARE_DIR = None
+
+# Request and query latencies, seconds.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric(object):
+    """
+    A named metric with labelled values.  Subclasses set `kind`, and
+    `merge`: how values of several processes are combined ('sum',
+    'live' to sum only running processes, or 'local' for values that
+    aren't shared).
+    """
+    kind = None
+    merge = 'sum'
+
+    def __init__(self, name, help):
+        """
+        @param name: string -- metric name.
+        @param help: string -- description shown to Prometheus.
+        """
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}
+        REGISTRY.append(self)
+
+    def snapshot(self):
+        """
+        @returns: dict -- copy of the values, {label key: value}.
+        """
+        with self.lock:
+            return dict(self.values)
+
+    def samples(self, values):
+        """
+        @param values: dict -- {label key: value}, see snapshot().
+
+        @returns: list of tuples (name suffix, labels dict, value)
+        """
+        return [('', dict(key), value) for key, value in values.items()]
+
+    def render(self, values):
+        """
+        @param values: dict -- {label key: value}, see snapshot().
+        """
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, labels, value in self.samples(values):
+            lines.append('%s%s%s %s' % (self.name, suffix,
+                                        formatLabels(labels), repr(float(value))))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """
+    A value that only goes up.
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down.  By default summed over the running
+    processes; pass merge='local' for values each process sets the
+    same (e.g. from the database at scrape time).
+    """
+    kind = 'gauge'
+    merge = 'live'
+
+    def __init__(self, name, help, merge=None):
+        Metric.__init__(self, name, help)
+        if merge:
+            self.merge = merge
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values (e.g. latencies) in cumulative
+    buckets, with their sum and count.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # one per bucket, then +Inf, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Context manager observing how long its block takes.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def snapshot(self):
+        with self.lock:
+            return dict((key, list(counts)) for key, counts in self.values.items())
+
+    def samples(self, values):
+        ret = []
+        for key, counts in values.items():
+            labels = dict(key)
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts[:-1]):
+                total += count
+                ret.append(('_bucket', dict(labels, le=str(bound)), total))
+            ret.append(('_sum', labels, counts[-1]))
+            ret.append(('_count', labels, total))
+        return ret
+
+
+def formatLabels(labels):
+    """
+    @param labels: dict -- label names to values.
+
+    @returns: string -- labels in the Prometheus text format.
+    """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').
+                     replace('\n', '\\n'))
+        for k, v in sorted(labels.items()))
+
+def addValue(a, b):
+    """
+    @returns: sum of two values of a metric (numbers, or the bucket
+        count lists of a histogram).
+    """
+    if isinstance(a, list):
+        return [x + y for x, y in zip(a, b)]
+    return a + b
+
+def sharePath(pid):
+    return os.path.join(SHARE_DIR, '%d.json' % pid)
+
+def flush():
+    """
+    Write this process's shared values to its file in SHARE_DIR.  The
+    file is replaced atomically so readers never see a partial one.
+    """
+    values = {}
+    for m in REGISTRY:
+        if m.merge != 'local':
+            values[m.name] = [[list(key), value]
+                              for key, value in m.snapshot().items()]
+    path = sharePath(os.getpid())
+    with open(path + '.tmp', 'w') as f:
+        json.dump(values, f)
+    os.rename(path + '.tmp', path)
+
+def flushLoop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            flush()
+        except (IOError, OSError):
+            logger.exception('writing metrics to %s', SHARE_DIR)
+
+def share(path, interval=1):
+    """
+    Share this process's values with the other processes that share
+    the same directory, see the module docstring.  The directory
+    should be emptied before the processes start (see gunicorn.conf),
+    or counters carry on from the files of earlier runs.
+
+    Call after forking; each process starts its own writer thread.
+
+    @param path: string -- directory for the per process files.
+    @param interval: seconds between writes.
+    """
+    global SHARE_DIR
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    SHARE_DIR = path
+    flush()
+    thread = threading.Thread(target=flushLoop, args=(interval,))
+    thread.daemon = True
+    thread.start()
+
+def isRunning(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+def merged(values):
+    """
+    Add the values in the files of the other processes to ours.
+
+    @param values: dict -- {metric name: snapshot()} of this process.
+
+    @returns: dict -- values in the same form, for the whole CC.
+    """
+    merges = dict((m.name, m.merge) for m in REGISTRY)
+    ours = sharePath(os.getpid())
+    for path in glob.glob(os.path.join(SHARE_DIR, '*.json')):
+        if path == ours:
+            continue
+        try:
+            pid = int(os.path.basename(path)[:-len('.json')])
+            with open(path) as f:
+                shared = json.load(f)
+        except (IOError, OSError, ValueError):
+            # Gone since the glob, or not one of ours.
+            continue
+        running = isRunning(pid)
+        for name, pairs in shared.items():
+            merge = merges.get(name)
+            if merge == 'local' or merge is None or \
+                    (merge == 'live' and not running):
+                continue
+            for key, value in pairs:
+                key = tuple(tuple(pair) for pair in key)
+                if key in values[name]:
+                    value = addValue(values[name][key], value)
+                values[name][key] = value
+    return values
+
+def render():
+    """
+    @returns: string -- every registered metric in the Prometheus text
+        format, for all processes sharing SHARE_DIR if share() was
+        called.
+    """
+    values = dict((m.name, m.snapshot()) for m in REGISTRY)
+    if SHARE_DIR:
+        values = merged(values)
+    return '\n'.join(m.render(values[m.name]) for m in REGISTRY) + '\n'
+
+
+REQUESTS = Counter('verodin_http_requests_total',
+                   'HTTP requests served, by route, method and status.')
+REQUEST_LATENCY = Histogram('verodin_http_request_duration_seconds',
+                            'Time to handle an HTTP request, by route.')
+REQUESTS_IN_FLIGHT = Gauge('verodin_http_requests_in_flight',
+                           'HTTP requests being handled.')
+CLAIM_QUERY_TIME = Histogram('verodin_claim_query_seconds',
+                             'Time claims spend selecting and locking hosts '
+                             'and jobs, by queue backend.')
+JOBS = Gauge('verodin_jobs', 'Jobs by queue state (see QueueStat).',
+             merge='local')
+AWS_LATENCY = Histogram('verodin_aws_call_duration_seconds',
+                        'Time taken by AWS calls, by call and region.')
@@ -0,0 +1,184 @@
+"""
+Schema migrations.
+
+`Base.metadata.create_all` only creates missing tables; it never
+changes a table that already exists.  Changes to existing tables
+(new columns, indexes, data moves) are written here as numbered
+migrations and applied by migrate(), which initDB() calls on startup.
+
+The applied version is kept in the schema_version table.  A new
+database is created straight from the models and stamped with the
+latest version.  A database created before migrations existed
+(has a job table but no schema_version) starts at version 0.
+
+To change the schema, change the model in ccLib.py and add a
+migration below that brings an existing database to the same shape.
+"""
+
+import sqlalchemy as DB
+from sqlalchemy.schema import CreateColumn
+
+import ccLib
+
+# Arbitrary key for pg_advisory_xact_lock; serializes migrate() across
+# the gunicorn workers and the poller starting at the same time.
+LOCK_KEY = 8317
+
+metadata = DB.MetaData()
+schemaVersion = DB.Table('schema_version', metadata,
+    DB.Column('version', DB.Integer, nullable=False))
+
+MIGRATIONS = []
+
+def migration(version, description):
+    """
+    Decorator registering a migration function.  The function is
+    called with a Connection inside the migration transaction.
+
+    @param version: int -- the schema version the migration produces.
+    @param description: string -- shown when the migration runs.
+    """
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort()
+        return func
+    return register
+
+def latestVersion():
+    """
+    @returns: int -- the version a fully migrated database has.
+    """
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+def migrate(engine):
+    """
+    Create missing tables and apply any pending migrations, all in one
+    transaction.
+
+    @param engine: DB engine.
+
+    @returns: int -- the schema version after migrating.
+    """
+    with engine.begin() as conn:
+        conn.execute(DB.select([DB.func.pg_advisory_xact_lock(LOCK_KEY)]))
+        metadata.create_all(conn)
+        version = conn.execute(DB.select([schemaVersion.c.version])).scalar()
+        if version is None:
+            if engine.dialect.has_table(conn, ccLib.Job.__tablename__):
+                version = 0
+            else:
+                version = latestVersion()
+            conn.execute(schemaVersion.insert().values(version=version))
+        ccLib.Base.metadata.create_all(conn)
+        for number, description, func in MIGRATIONS:
+            if number <= version:
+                continue
+            print('Migrating schema to version %s: %s' % (number, description))
+            func(conn)
+            conn.execute(schemaVersion.update().values(version=number))
+            version = number
+    return version
+
+def addColumns(conn, table, names):
+    """
+    Add model columns that are missing from an existing table.
+
+    @param conn: Connection
+    @param table: Table -- the model's table (e.g. Job.__table__)
+    @param names: list of strings -- columns to add.
+    """
+    existing = set(c['name'] for c in DB.inspect(conn).get_columns(table.name))
+    for name in names:
+        if name in existing:
+            continue
+        ddl = CreateColumn(table.c[name]).compile(dialect=conn.dialect)
+        conn.execute('ALTER TABLE %s ADD COLUMN %s' % (table.name, ddl))
+
+def createIndexes(conn, ddl):
+    """
+    Create indexes that are missing.
+
+    The definitions are written out in each migration rather than
+    taken from the model: the model has the latest definition, which
+    may use columns an older migration runs before.
+
+    @param conn: Connection
+    @param ddl: list of strings -- CREATE INDEX statements, without
+        the CREATE INDEX.  (e.g. 'ix_job_lease ON job (lease_expires)')
+    """
+    for statement in ddl:
+        conn.execute('CREATE INDEX IF NOT EXISTS %s' % statement)
+
+
+@migration(1, 'move job results to the result table')
+def resultStore(conn):
+    job = ccLib.Job.__table__
+    addColumns(conn, job, ['result_hash', 'result_size'])
+    columns = [c['name'] for c in DB.inspect(conn).get_columns(job.name)]
+    if 'result' not in columns:
+        return
+    lastId = 0
+    while True:
+        rows = conn.execute(DB.text(
+            'SELECT id, result FROM job '
+            'WHERE id > :id AND result IS NOT NULL '
+            'ORDER BY id LIMIT 1000'), id=lastId).fetchall()
+        if not rows:
+            break
+        refs = ccLib.Result.storeMany(conn, [row.result for row in rows])
+        conn.execute(DB.text(
+            'UPDATE job SET result_hash = :hash, result_size = :size '
+            'WHERE id = :id'),
+            [{'id': row.id, 'hash': digest, 'size': size}
+             for row, (digest, size) in zip(rows, refs)])
+        lastId = rows[-1].id
+    conn.execute('ALTER TABLE job DROP COLUMN result')
+
+@migration(2, 'job queue indexes')
+def jobIndexes(conn):
+    createIndexes(conn, [
+        'ix_job_claimable ON job (submit) WHERE start IS NULL',
+        'ix_job_inflight ON job (worker, url) '
+        'WHERE start IS NOT NULL AND complete IS NULL',
+        'ix_job_complete ON job (complete) WHERE complete IS NOT NULL'])
+    conn.execute('ANALYZE job')
+
+@migration(3, 'job leases')
+def jobLeases(conn):
+    addColumns(conn, ccLib.Job.__table__, ['lease_expires'])
+    # Anything claimed before leases existed gets one lease from its
+    # start time, so jobs abandoned long ago are reaped right away.
+    conn.execute(DB.text(
+        'UPDATE job SET lease_expires = start + :lease '
+        'WHERE start IS NOT NULL AND complete IS NULL'),
+        lease=ccLib.config.LEASE_SECONDS)
+    createIndexes(conn, [
+        'ix_job_lease ON job (lease_expires) '
+        'WHERE start IS NOT NULL AND complete IS NULL'])
+
+@migration(4, 'job retry backoff and dead letters')
+def jobRetries(conn):
+    job = ccLib.Job.__table__
+    addColumns(conn, job, ['attempts', 'not_before', 'dead', 'error'])
+    # The claim index now also excludes dead jobs.
+    conn.execute('DROP INDEX IF EXISTS ix_job_claimable')
+    createIndexes(conn, [
+        'ix_job_claimable ON job (submit) '
+        'WHERE start IS NULL AND dead IS NULL'])
+
+@migration(5, 'job hosts for host aware claiming')
+def jobHosts(conn):
+    job = ccLib.Job.__table__
+    addColumns(conn, job, ['host'])
+    # Same as Host.of(): the lower case netloc, '' if there is none.
+    conn.execute(
+        "UPDATE job SET host = coalesce(lower(substring(url from "
+        "'^[A-Za-z][A-Za-z0-9+.-]*://([^/?#]*)')), '')")
+    conn.execute(
+        'INSERT INTO host (name, in_flight, next_claim) '
+        'SELECT host, sum(CASE WHEN start IS NOT NULL AND complete IS NULL '
+        'THEN 1 ELSE 0 END), 0 FROM job GROUP BY host '
+        'ON CONFLICT DO NOTHING')
+    createIndexes(conn, [
+        'ix_job_host_claimable ON job (host, submit) '
+        'WHERE start IS NULL AND dead IS NULL'])
@@ -0,0 +1,52 @@
+"""
+Worker settings.  The start script gives CC_IP in VERODIN_CC_IP (or
+appends it to this file when installing from github).
+"""
+
+# Number of URLs fetched at the same time.
+FETCH_CONCURRENCY = 20
+
+# Number of URLs claimed from CC in one request.
+CLAIM_BATCH = 50
+
+# Claim more work when fewer than this many URLs are buffered.
+BUFFER_LOW_WATER = 20
+
+# Seconds to wait before asking again when CC has no work.
+IDLE_WAIT = 5
+
+# Seconds CC may hold a work request open waiting for jobs when the
+# buffer is empty (long poll).  0 to poll every IDLE_WAIT seconds
+# instead.  CC holds at most LONG_POLL_SLOTS requests per process and
+# answers the rest at once, in which case this falls back to polling.
+LONG_POLL = 20
+
+# Seconds to wait on an origin server.
+FETCH_TIMEOUT = 4
+
+# Pages up to STREAM_THRESHOLD bytes are sent to CC in the results
+# batch.  Bigger ones are streamed to CC on their own, STREAM_CHUNK
+# bytes at a time, and given up on (reported failed) past
+# RESULT_MAX_BYTES.
+STREAM_THRESHOLD = 256 * 1024
+STREAM_CHUNK = 64 * 1024
+RESULT_MAX_BYTES = 10 * 1024 * 1024
+
+# Origin connection pools: hosts kept, and the most connections open
+# to any one host (further fetches to that host wait for a free one).
+ORIGIN_POOL_HOSTS = 100
+ORIGIN_POOL_SIZE = 10
+
+# Kept alive connections to CC, and seconds to wait on it.
+CC_POOL_SIZE = 4
+CC_TIMEOUT = 5
+
+# Send results to CC once this many are queued...
+RESULT_BATCH = 50
+
+# ...or at least this many seconds after the last send.
+RESULT_FLUSH_INTERVAL = 2
+
+# Seconds between lease heartbeats to CC.  Must be well under the CC's
+# LEASE_SECONDS.
+HEARTBEAT_INTERVAL = 30
@@ -0,0 +1,6 @@
+#! /bin/sh
+# Runs the worker from an unpacked worker bundle (see src/workerBundle.py).
+# The dependencies are in ../lib; VERODIN_CC_IP must be set.
+cd "$(dirname "$0")"
+export PYTHONPATH="$(cd .. && pwd)/lib"
+exec ${PYTHON:-python2.7} worker.py
@@ -1,15 +1,29 @@
 """
 Worker processing.  This file only services a single endpoint used
-to verify communication.  The majority of the work originates from
-the scheduler.
+to verify communication.  The majority of the work is done by the
+fetch engine, which keeps a local buffer of claimed URLs and fetches
+many of them at once on a gevent pool.  Results are reported to CC in
+batches.  Housekeeping (hello) originates from the scheduler.
 """
 
+# Must happen before anything else imports socket/ssl/threading.
+from gevent import monkey
+monkey.patch_all()
+
+import gevent
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
 import flask
 from flask import Flask, request
 
 import requests
+from requests.compat import chardet
 from apscheduler.schedulers.background import BackgroundScheduler
 
+import codecs
+import collections
+import itertools
 import os
 import time
 
@@ -24,9 +38,16 @@ app = Flask(__name__, static_url_path='')
 app.debug = False
 app.config.from_object('config')
 app.config['CC_PORT'] = 8317
+# The environment overrides are for running many workers on one
+# machine (see localCloud.py in the CC).
+if os.environ.get('VERODIN_CC_IP'):
+    app.config['CC_IP'] = os.environ['VERODIN_CC_IP']
 app.state = {'hello': False,
-            'ip': workerLib.getMyIPAddress(),
-            'failedJobs': []}
+            'ip': os.environ.get('VERODIN_WORKER_IP') or workerLib.getMyIPAddress(),
+            'buffer': collections.deque(),
+            'inFlight': set(),
+            'results': [],
+            'lastFlush': time.time()}
 
 if LOCAL_DEV:
     # For dev on a machine running both cc.py and worker.py
@@ -35,6 +56,11 @@ if LOCAL_DEV:
 
 app.state['baseUrl'] = 'http://%s:%s' % (app.config['CC_IP'], app.config['CC_PORT'])
 
+# Kept alive connections to CC, and bounded pools for origin fetches.
+app.state['cc'] = workerLib.makeSession(1, app.config['CC_POOL_SIZE'])
+app.state['origin'] = workerLib.makeSession(app.config['ORIGIN_POOL_HOSTS'],
+            app.config['ORIGIN_POOL_SIZE'], block=True)
+
 def hello():
     """
     Try and send the Hello message to CC.
@@ -42,89 +68,286 @@ def hello():
     try:
         url = '%s/api/worker/%s' % (app.state['baseUrl'],
                     app.state['ip'])
-        resp = requests.get(url, timeout=2)
+        resp = app.state['cc'].get(url, timeout=app.config['CC_TIMEOUT'])
         resp.raise_for_status()
         app.state['hello'] = True
     except (requests.ConnectionError, requests.HTTPError):
         print('Failed to Send Hello Message')
         pass
 
-def getWork():
+def claimWork(wait=0):
+    """
+    Claim a batch of jobs from CC and add them to the local buffer.
+
+    @param wait: int -- seconds CC may hold the request waiting for
+        work if there is none (long poll).
+
+    @returns: int -- number of URLs claimed.
+
+    @Note: Network errors are left to the caller.
+    """
+    reqUrl = '%s/api/work/%s' % (app.state['baseUrl'],
+                app.state['ip'])
+    params = {'n': app.config['CLAIM_BATCH']}
+    if wait:
+        params['wait'] = wait
+    jobReq = app.state['cc'].get(reqUrl, params=params,
+                timeout=app.config['CC_TIMEOUT'] + wait)
+    jobReq.raise_for_status()
+    jobUrls = flask.json.loads(jobReq.text)['result'] or []
+    app.state['buffer'].extend(jobUrls)
+    return len(jobUrls)
+
+class ResultTooLarge(Exception):
+    """
+    The page is over RESULT_MAX_BYTES.
+    """
+
+
+class FetchFailed(Exception):
+    """
+    The origin failed while its page was being streamed to CC.
     """
-    Request a job from CC and process it.  If any network communication
-    issues arise fail the job.  If the job can't be failed (can't talk
-    to CC), queue for failing later.
+
+
+class UploadFailed(Exception):
     """
-    jobUrl = ''
+    CC didn't take a streamed page.
+    """
+
+
+def processJob(jobUrl):
+    """
+    Retrieve a single claimed URL and queue the result for CC, or
+    stream it to CC if it's large.  Only the first STREAM_THRESHOLD
+    bytes of a page are ever held.  If any network communication
+    issues arise with the origin the job is reported as failed; if CC
+    doesn't take a streamed page the job is left to its lease.
+
+    @param jobUrl: string -- The URL to retrieve.
+    """
+    app.state['inFlight'].add(jobUrl)
+    jobData = None
     try:
-        reqUrl = '%s/api/work/%s' % (app.state['baseUrl'],
-                    app.state['ip'])
-        jobReq = requests.get(reqUrl, timeout=2)
-        jobReq.raise_for_status()
-        jobUrl = flask.json.loads(jobReq.text)['result']
-        if jobUrl:
-            jobData = requests.get(jobUrl, timeout=4)
-            jobData.raise_for_status()
-            r = finishOrFail('finish', jobUrl, app.state['ip'], jobData.text)
-            r.raise_for_status()
-    except (requests.ConnectionError, requests.HTTPError, requests.RequestException):
+        jobData = app.state['origin'].get(jobUrl,
+                    timeout=app.config['FETCH_TIMEOUT'], stream=True)
+        jobData.raise_for_status()
+        length = jobData.headers.get('Content-Length')
+        if length and length.isdigit() and \
+                int(length) > app.config['RESULT_MAX_BYTES']:
+            raise ResultTooLarge('%s bytes' % length)
+        chunks = jobData.iter_content(app.config['STREAM_CHUNK'])
+        head = []
+        size = 0
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size > app.config['STREAM_THRESHOLD']:
+                break
+        head = ''.join(head)
+        encoding = pageEncoding(jobData, head)
+        if size <= app.config['STREAM_THRESHOLD']:
+            report('finish', jobUrl, head.decode(encoding, 'replace'))
+        else:
+            sendResult(jobUrl, utf8(itertools.chain([head], chunks), encoding))
+    except UploadFailed as e:
+        # CC's problem, not the page's.  Once the heartbeats stop the
+        # lease runs out and the job goes back in the queue without
+        # using up one of its attempts.
+        print('Failed to send result for %s: %s' % (jobUrl, e))
+    except (requests.ConnectionError, requests.HTTPError, requests.RequestException,
+            ResultTooLarge, FetchFailed) as e:
         # Some sort of issue (bad URl, network, results, etc)
-        # Try to fail the job
+        report('fail', jobUrl, '%s: %s' % (e.__class__.__name__, e))
+    finally:
+        if jobData is not None:
+            jobData.close()
+        app.state['inFlight'].discard(jobUrl)
+
+def pageEncoding(jobData, head):
+    """
+    The encoding requests would decode the page's text with, guessed
+    from its start if the headers don't say.
+
+    @param jobData: requests.Response
+    @param head: str -- the start of the page.
+
+    @returns: string -- a known codec name.
+    """
+    encoding = jobData.encoding or chardet.detect(head)['encoding']
+    try:
+        return codecs.lookup(encoding or 'utf-8').name
+    except LookupError:
+        return 'utf-8'
+
+def utf8(chunks, encoding):
+    """
+    Re-encode a page as UTF-8 as it is read.
+
+    @param chunks: iterator of str -- the page in its own encoding.
+    @param encoding: string -- that encoding.
+
+    @returns: iterator of str
+
+    @raises ResultTooLarge: once more than RESULT_MAX_BYTES are read.
+    @raises FetchFailed: if reading the page fails.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)('replace')
+    size = 0
+    chunks = itertools.chain(chunks, [None])
+    while True:
         try:
-            finishOrFail('fail', jobUrl, app.state['ip'], None)
-        except (requests.ConnectionError, requests.HTTPError, requests.RequestException):
-            if jobUrl:
-                # queue it for later failing.
-                app.state['failedJobs'].append(jobUrl)
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        except requests.RequestException as e:
+            # Told apart from CC's errors, which sendResult sees too.
+            raise FetchFailed('%s: %s' % (e.__class__.__name__, e))
+        if chunk is None:
+            text = decoder.decode('', True)
+        else:
+            size += len(chunk)
+            if size > app.config['RESULT_MAX_BYTES']:
+                raise ResultTooLarge('over %d bytes' % app.config['RESULT_MAX_BYTES'])
+            text = decoder.decode(chunk)
+        # An empty chunk would end a chunked upload.
+        if text:
+            yield text.encode('utf-8')
 
-def finishOrFail(op, jobUrl, id, data):
+def sendResult(jobUrl, body):
     """
-    Send a message to CC with success or failure information.
+    Stream a finished job's page to CC on its own (chunked), rather
+    than in the results batch.  CC stores it as it arrives.
 
-    @param op: string -- 'fail' or 'finish'
-    @param jobUrl: string -- The URL that was processed (or failed)
-    @param id: string -- IP of the worker.
-    @param data: The result of the processing.  None if the job failed.
+    @param jobUrl: string -- The URL that was processed.
+    @param body: iterator of str -- the page, UTF-8.
+
+    @raises UploadFailed: if CC can't be reached or fails.
+    @raises ResultTooLarge: if CC refuses the page as too big.
+    """
+    try:
+        r = app.state['cc'].post('%s/api/work/result' % app.state['baseUrl'],
+                    params={'id': app.state['ip'], 'url': jobUrl}, data=body,
+                    timeout=app.config['CC_TIMEOUT'])
+        r.raise_for_status()
+    except requests.RequestException as e:
+        if e.response is not None and e.response.status_code == 413:
+            raise ResultTooLarge('refused by CC')
+        raise UploadFailed('%s: %s' % (e.__class__.__name__, e))
 
-    @returns: The request.
+def engine():
+    """
+    The fetch engine.  Runs forever in its own greenlet.
+
+    Keeps the local buffer topped up from CC and hands buffered URLs to
+    a pool of FETCH_CONCURRENCY greenlets, so throughput is bound by
+    bandwidth and origin latency rather than by a polling interval.
+    """
+    pool = Pool(app.config['FETCH_CONCURRENCY'])
+    buf = app.state['buffer']
+    while True:
+        asked = time.time()
+        if len(buf) < app.config['BUFFER_LOW_WATER']:
+            # With nothing buffered, let CC hold the request until
+            # there is work rather than asking again and again.
+            wait = 0 if buf else app.config['LONG_POLL']
+            try:
+                claimWork(wait)
+            except (requests.ConnectionError, requests.HTTPError, requests.RequestException):
+                print('Failed to claim work')
+        if not buf:
+            # CC has nothing for us (or is unreachable, or had no long
+            # poll to spare and answered at once), back off for what
+            # is left of IDLE_WAIT.
+            gevent.sleep(max(0, app.config['IDLE_WAIT'] - (time.time() - asked)))
+            continue
+        pool.wait_available()
+        pool.spawn(processJob, buf.popleft())
 
-    @Note: This process doesn't catch any errors, that's left to the
-    caller.
+def report(op, jobUrl, data):
+    """
+    Queue a finish or fail report for CC.  The queue is flushed when
+    it reaches RESULT_BATCH entries or by flusher(), whichever comes
+    first.
+
+    @param op: string -- 'fail' or 'finish'
+    @param jobUrl: string -- The URL that was processed (or failed)
+    @param data: The result of the processing, or the reason the job
+        failed.
     """
     if op not in ('finish', 'fail'):
         op = 'fail' #safer
-    completionUrl = '%s/api/work/%s' % (app.state['baseUrl'], op)
-    postData = {
+    app.state['results'].append({
+        'op': op,
         'url': jobUrl,  # The url that specified in the job request.
-        'id': id,  # id of worker, (e.g. ip address)
-        'data': data  # Raw return or None
+        'data': data  # Raw return or failure reason
+    })
+    if len(app.state['results']) >= app.config['RESULT_BATCH']:
+        flushResults()
+
+def flushResults():
+    """
+    Send all queued reports to CC in one request.  If CC can't be
+    reached the reports are put back to be sent with the next flush.
+    """
+    batch = app.state['results']
+    if not batch:
+        return
+    app.state['results'] = []
+    app.state['lastFlush'] = time.time()
+    postData = {
+        'id': app.state['ip'],  # id of worker, (e.g. ip address)
+        'results': batch
     }
-    r = requests.post(completionUrl, json=postData)
-    r.raise_for_status()
-    return r
+    try:
+        r = app.state['cc'].post('%s/api/work/results' % app.state['baseUrl'],
+                    json=postData, timeout=app.config['CC_TIMEOUT'])
+        r.raise_for_status()
+    except (requests.ConnectionError, requests.HTTPError, requests.RequestException):
+        print('Failed to send results')
+        app.state['results'] = batch + app.state['results']
 
-def failQueue():
+def flusher():
     """
-    Make a new attempt to report failure to CC for any jobs that
-    couldn't be completed.
+    Flush queued reports RESULT_FLUSH_INTERVAL seconds after the last
+    flush.  Runs forever in its own greenlet.
+    """
+    interval = app.config['RESULT_FLUSH_INTERVAL']
+    while True:
+        wait = app.state['lastFlush'] + interval - time.time()
+        if wait > 0:
+            gevent.sleep(wait)
+        else:
+            flushResults()
+            app.state['lastFlush'] = time.time()
+
+def heartbeat():
     """
-    newQueue = []
-    for job in app.state['failedJobs']:
+    Extend the CC leases on every job this worker holds (buffered,
+    being fetched or waiting to be reported) every HEARTBEAT_INTERVAL
+    seconds.  Runs forever in its own greenlet.
+    """
+    while True:
+        gevent.sleep(app.config['HEARTBEAT_INTERVAL'])
+        urls = list(app.state['buffer']) + list(app.state['inFlight']) + \
+            [r['url'] for r in app.state['results']]
+        if not urls:
+            continue
         try:
-            finishOrFail('fail', job, app.state['ip'], None)
+            r = app.state['cc'].post('%s/api/work/heartbeat' % app.state['baseUrl'],
+                        json={'id': app.state['ip'], 'urls': urls},
+                        timeout=app.config['CC_TIMEOUT'])
+            r.raise_for_status()
         except (requests.ConnectionError, requests.HTTPError, requests.RequestException):
-            newQueue.append(job)
-    app.state['failedJobs'] = newQueue
-
+            print('Failed to send heartbeat')
 
 def tick():
     """
-    Scheduler callback.  Entry point into the worker.
+    Scheduler callback.  Housekeeping; the work itself is done by
+    engine().
     """
     if not app.state.get('hello'):
         hello()
-    failQueue()
-    getWork()
 
 def interval():
     """
@@ -147,5 +370,11 @@ def getHello():
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 6000))
     interval()
-    app.run(host='0.0.0.0', port=port)
+    gevent.spawn(engine)
+    gevent.spawn(flusher)
+    gevent.spawn(heartbeat)
+    host = '0.0.0.0'
+    if os.environ.get('VERODIN_WORKER_IP'):
+        host = app.state['ip']
+    WSGIServer((host, port), app).serve_forever()
 
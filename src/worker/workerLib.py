@@ -3,6 +3,7 @@ Much smaller worker lib.  Probably should just be rolled into worker.py.
 """
 
 import requests
+from requests.adapters import HTTPAdapter
 
 def getMyIPAddress():
     """
@@ -15,3 +16,21 @@ def getMyIPAddress():
     """
     return requests.get('https://api.ipify.org').text
 
+
+def makeSession(hosts, perHost, block=False):
+    """
+    Build a requests session with connection pooling and keep-alive.
+
+    @param hosts: int -- number of hosts to keep a connection pool for.
+    @param perHost: int -- connections kept open per host.
+    @param block: bool -- if True, never open more than perHost
+        connections to a host; further requests wait for a free one.
+
+    @returns: requests.Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=hosts, pool_maxsize=perHost,
+                          pool_block=block)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
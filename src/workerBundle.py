@@ -0,0 +1,332 @@
+"""
+Prebuilt worker bundle.
+
+New workers used to clone the repo, compile Python and pip install
+before doing any work.  Instead the CC builds a bundle once, a
+tarball of:
+
+    lib/ -- the worker's dependencies (worker/requirements.txt),
+        unpacked from wheels, to be put on PYTHONPATH.
+    worker/ -- the worker source, with run.sh to start it.
+
+Packages with C extensions come from manylinux1 wheels built for the
+workers' Python (WORKER_PYTHON_ABI), so it doesn't matter what the CC
+runs on.  Packages only published as source are built into wheels
+here; that only works for pure Python ones, so the build fails if such
+a wheel comes out platform specific (pin a version of the package
+that has manylinux1 wheels instead).  The wheels are cached in
+WORKER_BUNDLE_DIR/wheels.
+
+The tarball is reproducible and named by its sha256, which is also
+its version.  The start script from script() downloads it from the
+CC (/api/bundle/<sha256>.tar.gz), checks the hash, caches it on the
+instance and runs the worker with the instance's python2.7 as an
+upstart job.  That python is 2.7.6 on Ubuntu 14.04, whose ssl module
+has no SNI; the bundle carries pyOpenSSL, ndg-httpsclient and pyasn1
+(and their dependencies), which requests then uses instead.
+
+AWS.setup builds a bundle in the background if the worker source or
+requirements changed since the current one.  `python workerBundle.py`
+builds one by hand.
+"""
+
+import fcntl
+import glob
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from cStringIO import StringIO
+
+import config
+
+WORKER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker')
+REQUIREMENTS = os.path.join(WORKER_DIR, 'requirements.txt')
+
+
+def root():
+    """
+    @returns: string -- the bundle directory, created if needed.
+    """
+    path = os.path.abspath(config.WORKER_BUNDLE_DIR)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+def sources():
+    """
+    @returns: list of tuples (arcname, path) -- the worker files that
+        go in the bundle.
+    """
+    names = sorted(glob.glob(os.path.join(WORKER_DIR, '*.py')))
+    names += [os.path.join(WORKER_DIR, 'run.sh'), REQUIREMENTS]
+    return [('worker/' + os.path.basename(path), path) for path in names]
+
+def sourceHash():
+    """
+    @returns: string -- sha256 over the worker source and requirements;
+        a bundle is rebuilt when it changes.
+    """
+    digest = hashlib.sha256()
+    for arcname, path in sources():
+        with open(path, 'rb') as f:
+            digest.update(arcname + '\0' + f.read() + '\0')
+    return digest.hexdigest()
+
+def requirements():
+    """
+    @returns: list of strings -- pinned requirements (name==version).
+    """
+    with open(REQUIREMENTS) as f:
+        return [line.strip() for line in f
+                if line.strip() and not line.startswith('#')]
+
+def current():
+    """
+    @returns: dict or None if no bundle is built --
+            {
+            'sha256': string -- hash and version of the bundle,
+            'size': int -- bytes,
+            'source': string -- sourceHash() it was built from,
+            'built': float -- timestamp.
+            }
+    """
+    try:
+        with open(os.path.join(root(), 'current.json')) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if not path(manifest['sha256']):
+        return None
+    return manifest
+
+def path(sha256):
+    """
+    @param sha256: string -- bundle hash.
+
+    @returns: string or None -- path of the bundle with that hash, if
+        there is one.  Older bundles are kept for instances still
+        booting with them.
+    """
+    if not re.match('^[0-9a-f]{64}$', sha256):
+        return None
+    filename = os.path.join(root(), '%s.tar.gz' % sha256)
+    return filename if os.path.exists(filename) else None
+
+def pip(*args):
+    subprocess.check_call([sys.executable, '-m', 'pip'] + list(args))
+
+def fetchWheel(requirement):
+    """
+    Get the wheel of a pinned requirement for the workers, downloading
+    or building it if it isn't cached.
+
+    @param requirement: string -- name==version
+
+    @returns: string -- path of the wheel.
+
+    @raises ValueError: if the requirement has no manylinux1 wheel and
+        isn't pure Python.
+    """
+    dest = os.path.join(root(), 'wheels', requirement.replace('==', '-'))
+    wheels = glob.glob(os.path.join(dest, '*.whl'))
+    if not wheels:
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        tmp = tempfile.mkdtemp(dir=root())
+        try:
+            try:
+                pip('download', '--no-deps', '--only-binary=:all:',
+                    '--platform', config.WORKER_PLATFORM,
+                    '--python-version', '27', '--implementation', 'cp',
+                    '--abi', config.WORKER_PYTHON_ABI,
+                    '--dest', tmp, requirement)
+            except subprocess.CalledProcessError:
+                # Only published as source.  Built for the CC's Python,
+                # which only suits the workers if it's pure Python.
+                pip('wheel', '--no-deps', '--wheel-dir', tmp, requirement)
+                for wheel in glob.glob(os.path.join(tmp, '*.whl')):
+                    if not isPure(wheel):
+                        raise ValueError('%s has no %s wheel and is not pure '
+                                         'Python (%s)' % (requirement,
+                                         config.WORKER_PLATFORM,
+                                         os.path.basename(wheel)))
+            if os.path.isdir(dest):
+                shutil.rmtree(dest)
+            os.rename(tmp, dest)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        wheels = glob.glob(os.path.join(dest, '*.whl'))
+    return wheels[0]
+
+def isPure(wheel):
+    """
+    @param wheel: string -- path of a wheel.
+
+    @returns: bool -- whether its tags say it runs on any Python 2
+        (e.g. py2-none-any, py2.py3-none-any).
+    """
+    python, abi, platform = os.path.basename(wheel)[:-len('.whl')].split('-')[-3:]
+    return abi == 'none' and platform == 'any' and \
+        any(tag.startswith('py2') for tag in python.split('.'))
+
+def wheelFiles(wheel):
+    """
+    The files a wheel installs into site-packages.
+
+    @param wheel: string -- path of the wheel.
+
+    @returns: iterator of tuples (name, mode, data)
+    """
+    with zipfile.ZipFile(wheel) as z:
+        for info in z.infolist():
+            name = info.filename
+            if name.endswith('/'):
+                continue
+            parts = name.split('/', 2)
+            if parts[0].endswith('.data'):
+                # Only library files; no scripts, headers, etc.
+                if len(parts) < 3 or parts[1] not in ('purelib', 'platlib'):
+                    continue
+                name = parts[2]
+            mode = (info.external_attr >> 16) & 0777 or 0644
+            yield name, mode, z.read(info)
+
+def addFile(tar, name, mode, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = mode
+    info.mtime = 0
+    tar.addfile(info, StringIO(data))
+
+def build(force=False):
+    """
+    Build a bundle for the current worker source, unless the current
+    bundle already is (or force).  Builds by other processes are waited
+    for rather than repeated.
+
+    @param force: bool -- build even if the source didn't change.
+
+    @returns: dict -- the new current(), see there.
+    """
+    with open(os.path.join(root(), '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        source = sourceHash()
+        manifest = current()
+        if manifest and manifest['source'] == source and not force:
+            return manifest
+
+        files = {}
+        for requirement in requirements():
+            for name, mode, data in wheelFiles(fetchWheel(requirement)):
+                files.setdefault('lib/' + name, (mode, data))
+        for arcname, filename in sources():
+            with open(filename, 'rb') as f:
+                files[arcname] = (os.stat(filename).st_mode & 0777, f.read())
+
+        # No timestamps, owners or ordering differences: the same
+        # files always give the same bytes and so the same hash.
+        buf = StringIO()
+        gz = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+        tar = tarfile.open(fileobj=gz, mode='w')
+        for name in sorted(files):
+            addFile(tar, name, *files[name])
+        tar.close()
+        gz.close()
+        data = buf.getvalue()
+
+        sha256 = hashlib.sha256(data).hexdigest()
+        manifest = {'sha256': sha256, 'size': len(data), 'source': source,
+                    'built': time.time()}
+        writeAtomic(os.path.join(root(), '%s.tar.gz' % sha256), data)
+        writeAtomic(os.path.join(root(), 'current.json'), json.dumps(manifest))
+        print('Built worker bundle %s (%d bytes)' % (sha256, len(data)))
+        return manifest
+
+def writeAtomic(filename, data):
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, filename)
+
+def buildInBackground():
+    """
+    build() in a daemon thread, if the bundle is out of date.
+    """
+    manifest = current()
+    if manifest and manifest['source'] == sourceHash():
+        return
+    def run():
+        try:
+            build()
+        except (subprocess.CalledProcessError, IOError, OSError,
+                zipfile.BadZipfile, ValueError) as e:
+            print('Could not build the worker bundle: %s' % e)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+def script(manifest, ccIP, ccPort):
+    """
+    Start script for a new worker instance (EC2 user_data, run as
+    root) that fetches a bundle and runs it as the upstart job
+    verodin-worker, which restarts the worker if it exits and starts
+    it again after a reboot.
+
+    @param manifest: dict -- the bundle, see current().
+    @param ccIP: string -- address the worker reaches the CC at.
+    @param ccPort: int -- port of the CC.
+
+    @returns: string version of script.
+    """
+    return '''#!/bin/sh
+# Fetch and run worker bundle %(sha256)s
+set -e
+BUNDLE=%(sha256)s
+URL=http://%(ip)s:%(port)d/api/bundle/$BUNDLE.tar.gz
+ROOT=/opt/verodin-worker
+mkdir -p $ROOT/cache
+cd $ROOT
+if ! echo "$BUNDLE  cache/$BUNDLE.tar.gz" | sha256sum -c --status 2>/dev/null; then
+    for i in 1 2 3 4 5 6 7 8 9 10; do
+        curl -sSf -o cache/$BUNDLE.part "$URL" && break
+        sleep 3
+    done
+    echo "$BUNDLE  cache/$BUNDLE.part" | sha256sum -c --status
+    mv cache/$BUNDLE.part cache/$BUNDLE.tar.gz
+fi
+rm -rf $BUNDLE
+mkdir $BUNDLE
+tar -xzf cache/$BUNDLE.tar.gz -C $BUNDLE
+command -v python2.7 >/dev/null || (apt-get update && apt-get install -y python2.7)
+chown -R ubuntu:ubuntu $ROOT
+cat > /etc/init/verodin-worker.conf <<EOF
+description "Verodin worker"
+start on runlevel [2345]
+stop on runlevel [!2345]
+
+respawn
+respawn limit unlimited
+setuid ubuntu
+setgid ubuntu
+env VERODIN_CC_IP=%(ip)s
+
+exec sh $ROOT/$BUNDLE/worker/run.sh >> $ROOT/worker.log 2>&1
+post-stop exec sleep 5
+EOF
+initctl reload-configuration
+restart verodin-worker 2>/dev/null || start verodin-worker
+''' % {'sha256': manifest['sha256'], 'ip': ccIP, 'port': ccPort}
+
+
+if __name__ == '__main__':
+    print(json.dumps(build(force='--force' in sys.argv), indent=2))